@@ -0,0 +1,292 @@
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import AsyncMock, patch
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+import fetch_repos
+from fetch_engine import FetchEngine
+from http_cache import HttpCache, cache_key
+from issue_index import IssueIndex
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        status, headers, body = self.server.respond(self)
+        content = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+# Local stand-in for the GitHub API: respond(handler) returns (status, headers, json body) for each GET, and every
+# request's path and headers are kept in `requests`
+class StubServer(ThreadingHTTPServer):
+    def __init__(self, respond):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.respond = respond
+        self.requests = []
+        self.url = f'http://127.0.0.1:{self.server_port}'
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def run_engine(server, call, **options):
+    async def main():
+        engine = FetchEngine(base_url=server.url, **options)
+        try:
+            return await call(engine)
+        finally:
+            engine.close()
+    return asyncio.run(main())
+
+
+class TestFetchEngine(unittest.TestCase):
+    def serve(self, respond):
+        server = StubServer(respond)
+        self.addCleanup(server.stop)
+        return server
+
+    def test_follows_link_header_pages(self):
+        def respond(handler):
+            page = int(handler.path.rsplit('page=', 1)[-1]) if 'page=' in handler.path else 1
+            headers = {'Link': f'<{server.url}/search/issues?q=x&page={page + 1}>; rel="next"'} if page < 3 else {}
+            return 200, headers, {'items': [page * 10, page * 10 + 1]}
+        server = self.serve(respond)
+
+        items = run_engine(server, lambda engine: engine.get_all('/search/issues', {'q': 'x'}))
+
+        self.assertEqual(items, [10, 11, 20, 21, 30, 31])
+        self.assertEqual([path for path, _ in server.requests],
+                         ['/search/issues?q=x', '/search/issues?q=x&page=2', '/search/issues?q=x&page=3'])
+
+    def test_waits_out_retry_after(self):
+        def respond(handler):
+            if len(server.requests) == 1:
+                return 403, {'Retry-After': '1'}, {'message': 'secondary rate limit'}
+            return 200, {}, [1]
+        server = self.serve(respond)
+
+        started = time.monotonic()
+        response = run_engine(server, lambda engine: engine.get('/repos/a/b'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(server.requests), 2)
+        self.assertGreaterEqual(time.monotonic() - started, 0.9)
+
+    def test_waits_for_rate_limit_reset(self):
+        reset = time.time() + 1
+
+        def respond(handler):
+            if len(server.requests) == 1:
+                return 403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset)}, {'message': 'limit'}
+            return 200, {'X-RateLimit-Remaining': '4999'}, [1]
+        server = self.serve(respond)
+
+        response = run_engine(server, lambda engine: engine.get('/repos/a/b'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(server.requests), 2)
+        self.assertGreaterEqual(time.time(), reset - 0.05)
+
+    def test_retries_server_errors_with_backoff(self):
+        def respond(handler):
+            return (502, {}, None) if len(server.requests) < 3 else (200, {}, [1])
+        server = self.serve(respond)
+
+        with patch('fetch_engine.asyncio.sleep', new_callable=AsyncMock) as sleep, \
+                patch('fetch_engine.random.random', return_value=0.0):
+            response = run_engine(server, lambda engine: engine.get('/repos/a/b'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual([call.args[0] for call in sleep.await_args_list], [1, 2])
+
+    def test_gives_up_after_max_retries(self):
+        server = self.serve(lambda handler: (500, {}, None))
+
+        with patch('fetch_engine.asyncio.sleep', new_callable=AsyncMock), \
+                self.assertLogs('fetch_engine', 'ERROR') as logs:
+            items = run_engine(server, lambda engine: engine.get_all('/search/issues'), max_retries=2)
+
+        self.assertEqual(items, [])
+        self.assertEqual(len(server.requests), 3)
+        self.assertIn('Error fetching /search/issues: 500', logs.output[0])
+
+
+
+class TestHttpCache(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'http_cache.sqlite')
+        self.session = requests.Session()
+        self.addCleanup(self.session.close)
+
+    def serve(self, respond):
+        server = StubServer(respond)
+        self.addCleanup(server.stop)
+        return server
+
+    def open_cache(self, **options):
+        cache = HttpCache(self.path, **options)
+        self.addCleanup(cache.close)
+        return cache
+
+    def etag_server(self):
+        # Serves ETag "v1" and answers a matching If-None-Match with a bodiless 304
+        def respond(handler):
+            headers = {'ETag': '"v1"', 'X-RateLimit-Remaining': str(5000 - len(server.requests))}
+            if handler.headers.get('If-None-Match') == '"v1"':
+                return 304, headers, None
+            return 200, headers, {'items': [handler.path]}
+        server = self.serve(respond)
+        return server
+
+    def test_repeat_request_is_revalidated(self):
+        server = self.etag_server()
+        cache = self.open_cache()
+
+        first = cache.fetch(self.session, f'{server.url}/repos/a/b')
+        second = cache.fetch(self.session, f'{server.url}/repos/a/b')
+
+        self.assertNotIn('If-None-Match', server.requests[0][1])
+        self.assertEqual(server.requests[1][1]['If-None-Match'], '"v1"')
+        self.assertEqual((second.status_code, second.json()), (200, first.json()))
+        self.assertTrue(second.from_cache)
+        self.assertEqual(second.headers['X-RateLimit-Remaining'], '4998', "Rate limit headers come from the 304")
+        self.assertEqual((cache.hits, cache.revalidated, cache.misses), (0, 1, 1))
+
+    def test_engine_pages_are_revalidated(self):
+        server = self.etag_server()
+        cache = self.open_cache()
+
+        for _ in range(2):
+            items = run_engine(server, lambda engine: engine.get_all('/search/issues', {'q': 'x'}), cache=cache)
+            self.assertEqual(items, ['/search/issues?q=x'])
+
+        self.assertEqual(cache.stats(), '0 fresh hits, 1 revalidated (304), 1 downloaded')
+
+    def test_fresh_entries_skip_the_request(self):
+        server = self.etag_server()
+        cache = self.open_cache(fresh_for=60)
+
+        cache.fetch(self.session, f'{server.url}/repos/a/b')
+        self.assertTrue(cache.fetch(self.session, f'{server.url}/repos/a/b').from_cache)
+
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(cache.hits, 1)
+
+    def test_old_and_least_recently_used_entries_are_evicted(self):
+        server = self.serve(lambda handler: (200, {'ETag': '"v1"'}, {'padding': 'x' * 100}))
+        cache = self.open_cache(ttl=3600, max_bytes=250)
+        for path in ['/old', '/a', '/b', '/c']:
+            cache.fetch(self.session, f'{server.url}{path}')
+        cache.fetch(self.session, f'{server.url}/a')
+        with cache.con:
+            cache.con.execute("UPDATE responses SET accessed_at = accessed_at - 7200 WHERE url LIKE '%/old'")
+
+        cache.evict()
+
+        stored = {path: cache.lookup(cache_key(f'{server.url}{path}')[0]) is not None
+                  for path in ['/old', '/a', '/b', '/c']}
+        self.assertEqual(stored, {'/old': False, '/a': True, '/b': False, '/c': True})
+
+
+def issue(server, number, repo, title, updated_at, state='open'):
+    return {'id': number, 'number': number, 'repository_url': f'{server.url}/repos/{repo}', 'title': title,
+            'body': f'{title} body', 'html_url': f'https://github.com/{repo}/issues/{number}', 'state': state,
+            'labels': [{'name': 'good first issue'}], 'created_at': '2026-09-01T00:00:00Z', 'updated_at': updated_at}
+
+
+class TestIssueIndex(unittest.TestCase):
+    REPOS = {'o/small': ('Python', 2), 'o/big': ('Python', 50)}
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.index_file = os.path.join(tmp_dir.name, 'issues.sqlite')
+        self.issues = []
+        self.server = StubServer(self.respond)
+        self.addCleanup(self.server.stop)
+
+    def respond(self, handler):
+        url = urlsplit(handler.path)
+        if url.path == '/search/issues':
+            return 200, {}, {'total_count': len(self.issues), 'items': self.issues}
+        name = url.path[len('/repos/'):]
+        language, stars = self.REPOS[name]
+        return 200, {}, {'full_name': name, 'html_url': f'https://github.com/{name}', 'language': language,
+                         'stargazers_count': stars, 'created_at': '2020-01-01T00:00:00Z'}
+
+    def scan(self, issues):
+        self.issues = issues
+        with redirect_stdout(io.StringIO()):
+            asyncio.run(fetch_repos.run(base_url=self.server.url, cache_file=None, index_file=self.index_file))
+
+    def search_queries(self):
+        return [parse_qs(urlsplit(path).query)['q'][0] for path, _ in self.server.requests
+                if path.startswith('/search/issues')]
+
+    def test_second_scan_only_asks_for_updated_issues(self):
+        self.scan([issue(self.server, 1, 'o/small', 'Fix docs typo', '2026-10-01T00:00:00Z'),
+                   issue(self.server, 2, 'o/big', 'Improve docs index', '2026-10-02T00:00:00Z'),
+                   issue(self.server, 3, 'o/big', 'Add tests', '2026-10-03T00:00:00Z')])
+        self.scan([issue(self.server, 3, 'o/big', 'Add tests', '2026-10-03T00:00:00Z'),
+                   issue(self.server, 2, 'o/big', 'Improve docs index', '2026-10-05T00:00:00Z', state='closed'),
+                   issue(self.server, 4, 'o/big', 'Write docs for the CLI', '2026-10-06T00:00:00Z')])
+
+        first, second = self.search_queries()
+        self.assertIn('is:open', first)
+        self.assertNotIn('updated:', first)
+        self.assertIn('updated:>=2026-10-03T00:00:00Z', second)
+        self.assertNotIn('is:open', second)
+        repo_requests = [path for path, _ in self.server.requests if path.startswith('/repos/')]
+        self.assertEqual(sorted(repo_requests), ['/repos/o/big', '/repos/o/small'], "Repos are refreshed daily")
+
+        index = IssueIndex(self.index_file)
+        self.addCleanup(index.close)
+        self.assertEqual(index.watermark(), '2026-10-06T00:00:00Z')
+        self.assertEqual(index.con.execute("SELECT id, state FROM issues ORDER BY id").fetchall(),
+                         [(1, 'open'), (2, 'closed'), (3, 'open'), (4, 'open')])
+
+    def test_search_filters_full_text_matches(self):
+        self.scan([issue(self.server, 1, 'o/small', 'Fix docs typo', '2026-10-01T00:00:00Z'),
+                   issue(self.server, 2, 'o/big', 'Improve docs index', '2026-10-02T00:00:00Z', state='closed'),
+                   issue(self.server, 3, 'o/big', 'Add tests', '2026-10-03T00:00:00Z'),
+                   issue(self.server, 4, 'o/big', 'Write docs for the CLI', '2026-10-04T00:00:00Z')])
+        index = IssueIndex(self.index_file)
+        self.addCleanup(index.close)
+        titles = lambda rows: [row[3] for row in rows]
+
+        self.assertEqual(titles(index.search('docs', min_stars=5)), ['Write docs for the CLI'])
+        self.assertEqual(titles(index.search('docs', min_stars=5, state=None)),
+                         ['Write docs for the CLI', 'Improve docs index'])
+        self.assertEqual(titles(index.search('docs')), ['Write docs for the CLI', 'Fix docs typo'])
+        self.assertEqual(index.search('docs', language='rust'), [])
+        self.assertEqual(titles(index.search(min_stars=5, language='python')),
+                         ['Write docs for the CLI', 'Add tests'])
+
+if __name__ == '__main__':
+    unittest.main()
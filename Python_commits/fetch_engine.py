@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import random
+import re
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+API_URL = "https://api.github.com"
+NEXT_LINK = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+
+def next_page_url(response):
+    match = NEXT_LINK.search(response.headers.get('Link', ''))
+    return match.group(1) if match else None
+
+
+# Requests run on one pooled keep-alive requests.Session in worker threads, at most `concurrency` at a time.
+# When GitHub reports the rate limit is used up (X-RateLimit-Remaining: 0) or sends Retry-After, every request
+# waits until the limit resets instead of burning retries. With an http_cache.HttpCache, repeat requests are sent
+# conditionally and 304s are answered from the cache. Create the engine inside the event loop that uses it.
+class FetchEngine:
+    def __init__(self, headers=None, concurrency=8, max_retries=5, timeout=30, base_url=API_URL, cache=None):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.cache = cache
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.resume_at = 0.0
+
+    def close(self):
+        self.session.close()
+
+    def url(self, path):
+        return path if path.startswith('http') else f"{self.base_url}/{path.lstrip('/')}"
+
+    def request(self, url, params=None):
+        if self.cache is not None:
+            return self.cache.fetch(self.session, self.url(url), params=params, timeout=self.timeout)
+        return self.session.get(self.url(url), params=params, timeout=self.timeout)
+
+    def note_rate_limit(self, response):
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            self.resume_at = max(self.resume_at, time.time() + float(retry_after))
+        elif response.headers.get('X-RateLimit-Remaining') == '0':
+            reset = response.headers.get('X-RateLimit-Reset')
+            self.resume_at = max(self.resume_at, float(reset) if reset else time.time() + 60)
+
+    def should_retry(self, response):
+        if response.status_code >= 500:
+            return True
+        return response.status_code in (403, 429) and (
+            'Retry-After' in response.headers or response.headers.get('X-RateLimit-Remaining') == '0')
+
+    async def wait_for_rate_limit(self):
+        delay = self.resume_at - time.time()
+        if delay > 0:
+            logger.info(f"Rate limited, waiting {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def get(self, url, params=None):
+        response = None
+        for attempt in range(self.max_retries + 1):
+            await self.wait_for_rate_limit()
+            async with self.semaphore:
+                try:
+                    response = await asyncio.to_thread(self.request, url, params)
+                except requests.RequestException as e:
+                    logger.warning(f"Request to {url} failed: {e}")
+                    response = None
+            if response is not None:
+                self.note_rate_limit(response)
+                if not self.should_retry(response):
+                    return response
+                if self.resume_at > time.time():
+                    # wait_for_rate_limit covers the pause, no extra backoff needed
+                    continue
+            if attempt < self.max_retries:
+                await asyncio.sleep(min(60, 2 ** attempt) + random.random())
+        return response
+
+    async def get_pages(self, url, params=None, max_pages=None):
+        pages = 0
+        while url and (max_pages is None or pages < max_pages):
+            response = await self.get(url, params)
+            if response is None or response.status_code != 200:
+                status = response.status_code if response is not None else 'no response'
+                logger.error(f"Error fetching {url}: {status}")
+                return
+            yield response.json()
+            pages += 1
+            # The next link already carries the query string
+            url, params = next_page_url(response), None
+
+    async def get_all(self, url, params=None, max_pages=None):
+        items = []
+        async for page in self.get_pages(url, params, max_pages):
+            items.extend(page['items'] if isinstance(page, dict) and 'items' in page else page)
+        return items
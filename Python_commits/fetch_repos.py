@@ -1,47 +1,118 @@
-import requests
-from datetime import datetime, timedelta
+import argparse
+import asyncio
 import logging
 import configparser
 
+from fetch_engine import API_URL, FetchEngine
+from http_cache import HttpCache
+from issue_index import IssueIndex, repo_name
+
 parser =configparser.ConfigParser(interpolation=None)
 parser.read('api.conf')
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
-TOKEN = parser.get('API Conf', 'token')
-headers = {'Authorization': f'token {TOKEN}'}
+TOKEN = parser.get('API Conf', 'token', fallback=None)
+BASE_URL = parser.get('API Conf', 'api_url', fallback=API_URL)
+CONCURRENCY = parser.getint('API Conf', 'concurrency', fallback=8)
+CACHE_FILE = parser.get('API Conf', 'cache_file', fallback='http_cache.sqlite')
+CACHE_TTL_DAYS = parser.getfloat('API Conf', 'cache_ttl_days', fallback=7)
+CACHE_MAX_MB = parser.getfloat('API Conf', 'cache_max_mb', fallback=200)
+INDEX_FILE = parser.get('API Conf', 'index_file', fallback='issues.sqlite')
+LABEL = parser.get('API Conf', 'label', fallback='good first issue')
+LANGUAGE = parser.get('API Conf', 'language', fallback='python')
+headers = {'Authorization': f'token {TOKEN}'} if TOKEN else {}
 
-def fetch_repos():
-    six_months_ago = datetime.now() - timedelta(weeks=50)
-    date_str = six_months_ago.strftime('%Y-%m-%d')
+# The search API stops at 1000 results per query
+SEARCH_LIMIT = 1000
 
+def issue_query(since=None):
+    qualifiers = [f'label:"{LABEL}"', 'is:issue']
+    if LANGUAGE:
+        qualifiers.append(f'language:{LANGUAGE}')
+    # The first scan only wants open issues, later ones also need the ones closed since so the index drops them
+    qualifiers.append(f'updated:>={since}' if since else 'is:open')
+    return ' '.join(qualifiers)
 
-    url = f"https://api.github.com/search/repositories?q=created:>{date_str}+language:python&sort=stars&order=desc"
+async def search_issues(engine, since=None):
+    # The label filter runs server side, pages are yielded as they arrive, oldest update first
+    while True:
+        params = {'q': issue_query(since), 'sort': 'updated', 'order': 'asc', 'per_page': 100}
+        seen, last = 0, None
+        async for page in engine.get_pages('/search/issues', params):
+            if page['items']:
+                seen += len(page['items'])
+                last = page['items'][-1]['updated_at']
+                yield page['items']
+        if seen < SEARCH_LIMIT or last is None or last == since:
+            return
+        # Past the cap, carry on with a new query from the last update seen (overlap is upserted again)
+        since = last
 
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()['items']
-    else:
-        print("Error fetching repositories", response.status_code)
-        return []
-
-def fetch_issues(repo):
-    issues_url = repo['issues_url'].replace('{/number}', '?state=open')
-    response = requests.get(issues_url, headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Error fetching issues for {repo['name']}: {response.status_code}")
-        return []
+async def with_repos(engine, index, pages):
+    # Star count, language and age live on the repository, each one is fetched once a day at most
+    async for issues in pages:
+        names = index.stale_repos(sorted({repo_name(issue) for issue in issues}))
+        responses = await asyncio.gather(*(engine.get(f'/repos/{name}') for name in names))
+        index.store_repos([response.json() for response in responses
+                           if response is not None and response.status_code == 200])
+        yield issues
+
+async def scan(engine, index):
+    since = index.watermark()
+    logger.info(f"Searching issues: {issue_query(since)}")
+    async for issues in with_repos(engine, index, search_issues(engine, since)):
+        for issue in index.store_issues(issues):
+            if issue['state'] == 'open':
+                print(f"Repository: {repo_name(issue)}, Issue: {issue['title']}, URL: {issue['html_url']}")
+    logger.info(f"Issue index: {index.stats()}")
+
+async def run(base_url=BASE_URL, concurrency=CONCURRENCY, cache_file=CACHE_FILE, index_file=INDEX_FILE):
+    cache = None
+    if cache_file:
+        cache = HttpCache(cache_file, ttl=CACHE_TTL_DAYS * 24 * 3600, max_bytes=int(CACHE_MAX_MB * 1024 * 1024))
+    engine = FetchEngine(headers, concurrency=concurrency, base_url=base_url, cache=cache)
+    index = IssueIndex(index_file)
+    try:
+        await scan(engine, index)
+    finally:
+        engine.close()
+        index.close()
+        if cache is not None:
+            logger.info(f"HTTP cache: {cache.stats()}")
+            cache.close()
+
+def search(args):
+    index = IssueIndex(args.index_file)
+    try:
+        rows = index.search(' '.join(args.text) or None, args.min_stars, args.language, args.max_age_days,
+                            args.repo_max_age_days, None if args.all_states else 'open', args.limit)
+    finally:
+        index.close()
+    for repo, stars, language, title, url, created_at in rows:
+        print(f"Repository: {repo} ({stars} stars, {language}), Issue: {title}, Opened: {created_at[:10]}, URL: {url}")
 
 def main():
-    repos = fetch_repos()
-    for repo in repos:
-        issues = fetch_issues(repo)
-        for issue in issues:
-            if 'good first issue' in [label['name'] for label in issue['labels']]:
-                print(f"Repository: {repo['name']}, Issue: {issue['title']}, URL: {issue['html_url']}")
+    arg_parser = argparse.ArgumentParser(description=f'Index and search "{LABEL}" issues')
+    arg_parser.add_argument('--index-file', default=INDEX_FILE)
+    commands = arg_parser.add_subparsers(dest='command')
+    commands.add_parser('scan', help='fetch issues updated since the last scan into the index (default)')
+    search_parser = commands.add_parser('search', help='query the local index')
+    search_parser.add_argument('text', nargs='*', help='full-text query over title and body (FTS5 syntax)')
+    search_parser.add_argument('--min-stars', type=int, default=None)
+    search_parser.add_argument('--language', default=None)
+    search_parser.add_argument('--max-age-days', type=float, default=None, help='only issues opened this recently')
+    search_parser.add_argument('--repo-max-age-days', type=float, default=None,
+                               help='only repositories created this recently')
+    search_parser.add_argument('--all-states', action='store_true', help='include issues closed since indexing')
+    search_parser.add_argument('--limit', type=int, default=20)
+    args = arg_parser.parse_args()
+
+    if args.command == 'search':
+        search(args)
+    else:
+        asyncio.run(run(index_file=args.index_file))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
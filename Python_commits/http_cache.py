@@ -0,0 +1,147 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+RATE_LIMIT_HEADERS = ('Retry-After', 'X-RateLimit-Limit', 'X-RateLimit-Remaining', 'X-RateLimit-Reset',
+                      'X-RateLimit-Used', 'X-RateLimit-Resource')
+# Per-response headers that must not be replayed from the cache
+VOLATILE_HEADERS = {name.lower() for name in RATE_LIMIT_HEADERS + ('Date', 'Content-Encoding', 'Content-Length',
+                                                                   'Transfer-Encoding')}
+
+
+def auth_scope(headers):
+    # Responses differ per token (private repos, rate limits), so the token is part of the key, hashed
+    authorization = (headers or {}).get('Authorization')
+    return hashlib.sha256(authorization.encode()).hexdigest()[:16] if authorization else 'anonymous'
+
+
+def cache_key(url, params=None, scope='anonymous'):
+    if params:
+        url = f"{url}{'&' if '?' in url else '?'}{urlencode(sorted(params.items()))}"
+    return hashlib.sha256(f"{scope} {url}".encode()).hexdigest(), url
+
+
+# GET responses are stored in SQLite with their ETag / Last-Modified. Entries younger than `fresh_for` seconds
+# are returned without a request, older ones are revalidated with If-None-Match / If-Modified-Since so an
+# unchanged page costs a 304 (free against the GitHub rate limit). Entries unused for `ttl` seconds are
+# dropped, and the least recently used ones go once the cache grows past `max_bytes`.
+class HttpCache:
+    def __init__(self, path='http_cache.sqlite', ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES, fresh_for=0):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.fresh_for = fresh_for
+        self.hits = self.revalidated = self.misses = 0
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key text PRIMARY KEY,
+            url text,
+            scope text,
+            headers text,
+            body blob,
+            etag text,
+            last_modified text,
+            stored_at real,
+            accessed_at real,
+            size integer)''')
+        self.con.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses(accessed_at)")
+        self.con.commit()
+        self.evict()
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.con.close()
+
+    def lookup(self, key):
+        with self.lock:
+            return self.con.execute("SELECT url, headers, body, etag, last_modified, stored_at FROM responses "
+                                    "WHERE key = ?", (key,)).fetchone()
+
+    def store(self, key, url, scope, response):
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in VOLATILE_HEADERS}
+        now = time.time()
+        with self.lock, self.con:
+            self.con.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (key, url, scope, json.dumps(headers), response.content,
+                              response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                              now, now, len(response.content)))
+
+    def touch(self, key, response=None):
+        now = time.time()
+        with self.lock, self.con:
+            self.con.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            if response is not None:
+                # A 304 restarts the freshness clock and may carry a new validator
+                self.con.execute("UPDATE responses SET stored_at = ?, etag = coalesce(?, etag), "
+                                 "last_modified = coalesce(?, last_modified) WHERE key = ?",
+                                 (now, response.headers.get('ETag'), response.headers.get('Last-Modified'), key))
+
+    def evict(self):
+        with self.lock, self.con:
+            self.con.execute("DELETE FROM responses WHERE accessed_at < ?", (time.time() - self.ttl,))
+            total = self.con.execute("SELECT coalesce(sum(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                cursor = self.con.execute("SELECT key, size FROM responses ORDER BY accessed_at")
+                doomed = []
+                for key, size in cursor:
+                    if total <= self.max_bytes:
+                        break
+                    doomed.append((key,))
+                    total -= size
+                self.con.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def cached_response(self, entry, response=None):
+        url, headers, body, _, _, _ = entry
+        cached = requests.Response()
+        cached.status_code = 200
+        cached.url = url
+        cached._content = body
+        cached.encoding = 'utf-8'
+        cached.headers = CaseInsensitiveDict(json.loads(headers))
+        if response is not None:
+            # Keep the live rate limit headers of the 304 so the caller still sees them
+            cached.headers.update({name: response.headers[name] for name in RATE_LIMIT_HEADERS
+                                   if name in response.headers})
+        cached.from_cache = True
+        return cached
+
+    def fetch(self, session, url, params=None, **kwargs):
+        scope = auth_scope(session.headers)
+        key, full_url = cache_key(url, params, scope)
+        entry = self.lookup(key)
+        if entry is not None and time.time() - entry[5] < self.fresh_for:
+            self.hits += 1
+            self.touch(key)
+            return self.cached_response(entry)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry is not None:
+            if entry[3]:
+                headers['If-None-Match'] = entry[3]
+            if entry[4]:
+                headers['If-Modified-Since'] = entry[4]
+        response = session.get(url, params=params, headers=headers, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            self.touch(key, response)
+            return self.cached_response(entry, response)
+        self.misses += 1
+        if response.status_code == 200 and (self.fresh_for or response.headers.get('ETag')
+                                            or response.headers.get('Last-Modified')):
+            self.store(key, full_url, scope, response)
+        return response
+
+    def stats(self):
+        return f"{self.hits} fresh hits, {self.revalidated} revalidated (304), {self.misses} downloaded"
@@ -0,0 +1,134 @@
+import json
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+
+REPO_REFRESH = 24 * 3600
+
+
+def github_time(days_ago):
+    # Same ISO 8601 form GitHub returns, so cutoffs compare as plain strings
+    return (datetime.now(timezone.utc) - timedelta(days=days_ago)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def repo_name(issue):
+    # https://api.github.com/repos/<owner>/<name>
+    return '/'.join(issue['repository_url'].rsplit('/', 2)[-2:])
+
+
+# Local index of matching issues and their repositories. issues_fts is an external-content FTS5 table over
+# issues.title / issues.body, kept in step by triggers. The highest updated_at stored is the watermark the next scan
+# searches from; results arrive sorted by updated_at, so it only moves forward with each committed page and an
+# interrupted scan resumes where it stopped.
+class IssueIndex:
+    def __init__(self, path='issues.sqlite'):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.executescript('''
+            CREATE TABLE IF NOT EXISTS repos (
+                full_name text PRIMARY KEY,
+                html_url text,
+                language text,
+                stars integer,
+                created_at text,
+                fetched_at real);
+            CREATE TABLE IF NOT EXISTS issues (
+                id integer PRIMARY KEY,
+                repo text,
+                number integer,
+                title text,
+                body text,
+                html_url text,
+                state text,
+                labels text,
+                created_at text,
+                updated_at text);
+            CREATE INDEX IF NOT EXISTS issues_repo ON issues(repo);
+            CREATE INDEX IF NOT EXISTS issues_created_at ON issues(created_at);
+            CREATE TABLE IF NOT EXISTS index_state (key text PRIMARY KEY, value text);
+            CREATE VIRTUAL TABLE IF NOT EXISTS issues_fts USING fts5(title, body, content='issues', content_rowid='id');
+            CREATE TRIGGER IF NOT EXISTS issues_fts_insert AFTER INSERT ON issues BEGIN
+                INSERT INTO issues_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+            END;
+            CREATE TRIGGER IF NOT EXISTS issues_fts_delete AFTER DELETE ON issues BEGIN
+                INSERT INTO issues_fts(issues_fts, rowid, title, body) VALUES ('delete', old.id, old.title, old.body);
+            END;
+            CREATE TRIGGER IF NOT EXISTS issues_fts_update AFTER UPDATE ON issues BEGIN
+                INSERT INTO issues_fts(issues_fts, rowid, title, body) VALUES ('delete', old.id, old.title, old.body);
+                INSERT INTO issues_fts(rowid, title, body) VALUES (new.id, new.title, new.body);
+            END;''')
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def watermark(self):
+        row = self.con.execute("SELECT value FROM index_state WHERE key = 'updated_at'").fetchone()
+        return row[0] if row else None
+
+    def stale_repos(self, names, max_age=REPO_REFRESH):
+        fresh = {row[0] for row in self.con.execute(
+            f"SELECT full_name FROM repos WHERE fetched_at > ? AND full_name IN ({', '.join('?' for _ in names)})",
+            (time.time() - max_age, *names))}
+        return [name for name in names if name not in fresh]
+
+    def store_repos(self, repos):
+        now = time.time()
+        with self.con:
+            self.con.executemany("INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(repo['full_name'], repo['html_url'], repo.get('language'),
+                                   repo.get('stargazers_count'), repo.get('created_at'), now) for repo in repos])
+
+    def store_issues(self, issues):
+        rows = [(issue['id'], repo_name(issue), issue['number'], issue['title'], issue.get('body') or '',
+                 issue['html_url'], issue['state'], json.dumps([label['name'] for label in issue['labels']]),
+                 issue['created_at'], issue['updated_at']) for issue in issues]
+        if not rows:
+            return []
+        placeholders = ', '.join('?' for _ in rows)
+        known = dict(self.con.execute(f"SELECT id, updated_at FROM issues WHERE id IN ({placeholders})",
+                                      [row[0] for row in rows]))
+        # One transaction per page: the issues and the watermark they move land together
+        with self.con:
+            self.con.executemany('''INSERT INTO issues VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                    ON CONFLICT(id) DO UPDATE SET title = excluded.title, body = excluded.body,
+                                    state = excluded.state, labels = excluded.labels,
+                                    updated_at = excluded.updated_at''', rows)
+            self.con.execute('''INSERT INTO index_state VALUES ('updated_at', ?)
+                                ON CONFLICT(key) DO UPDATE SET value = max(value, excluded.value)''',
+                             (max(row[9] for row in rows),))
+        # New issues or ones updated since they were stored (the >= watermark query overlaps the last scan)
+        return [issue for issue in issues if known.get(issue['id']) != issue['updated_at']]
+
+    def search(self, text=None, min_stars=None, language=None, max_age_days=None, repo_max_age_days=None,
+               state='open', limit=20):
+        conditions, params = [], []
+        if text:
+            conditions.append("i.id IN (SELECT rowid FROM issues_fts WHERE issues_fts MATCH ?)")
+            params.append(text)
+        if state:
+            conditions.append("i.state = ?")
+            params.append(state)
+        if min_stars is not None:
+            conditions.append("r.stars >= ?")
+            params.append(min_stars)
+        if language:
+            conditions.append("r.language = ? COLLATE NOCASE")
+            params.append(language)
+        if max_age_days is not None:
+            conditions.append("i.created_at >= ?")
+            params.append(github_time(max_age_days))
+        if repo_max_age_days is not None:
+            conditions.append("r.created_at >= ?")
+            params.append(github_time(repo_max_age_days))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self.con.execute(f'''SELECT i.repo, r.stars, r.language, i.title, i.html_url, i.created_at
+                                    FROM issues i LEFT JOIN repos r ON r.full_name = i.repo {where}
+                                    ORDER BY r.stars DESC, i.updated_at DESC LIMIT ?''', (*params, limit)).fetchall()
+
+    def stats(self):
+        issues, open_issues = self.con.execute(
+            "SELECT count(*), count(*) FILTER (WHERE state = 'open') FROM issues").fetchone()
+        repos = self.con.execute("SELECT count(*) FROM repos").fetchone()[0]
+        return f"{open_issues} open of {issues} indexed issues across {repos} repositories"
@@ -1,6 +1,8 @@
 import requests
 from datetime import datetime, timedelta
 
+from http_cache import HttpCache
+
 # Calculate the date 3 weeks ago from today
 three_weeks_ago = datetime.now() - timedelta(weeks=10)
 date_str = three_weeks_ago.strftime('%Y-%m-%d')
@@ -8,8 +10,10 @@ date_str = three_weeks_ago.strftime('%Y-%m-%d')
 # Corrected URL
 url = f"https://api.github.com/search/repositories?q=stars:<20+created:>{date_str}+language:python&sort=stars&order=desc"
 
-# Make the request to the GitHub API
-response = requests.get(url)
+# Make the request to the GitHub API, repeat runs revalidate the cached copy with If-None-Match
+cache = HttpCache('http_cache.sqlite')
+response = cache.fetch(requests.Session(), url)
+cache.close()
 
 # Check if the request was successful
 if response.status_code == 200:
@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import Pipeline_writers as pw
+import Subscriber_Pipeline_Functions as sp
+from Pipeline_main import pipeline
+
+NULLABLE_COLUMNS = ["job_id", "num_course_taken", "current_career_path_id", "time_spent_hrs"]
+SIZES = {"10k": 10_000, "100k": 100_000, "1M": 1_000_000, "10M": 10_000_000}
+PASSES = ["initial", "rerun"]
+
+
+def parse_size(size):
+    if size in SIZES:
+        return SIZES[size]
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(size[-1].lower(), 1)
+    return int(float(size.rstrip("kKmM")) * multiplier)
+
+
+def profile_source(db):
+    con = sqlite3.connect(db)
+    students_df = pd.DataFrame(con.execute("SELECT * FROM cademycode_students"), columns=sp.STUDENT_COLUMNS)
+    con.close()
+
+    null_patterns = students_df[NULLABLE_COLUMNS].isna().value_counts(normalize=True)
+    names = students_df["name"].dropna().str.split(" ", n=1, expand=True)
+    contact_df = sp.parse_contact_info(students_df["contact_info"])
+    dob = pd.to_datetime(students_df["dob"], errors="coerce").dropna()
+
+    return {
+        "null_patterns": [list(map(bool, pattern)) for pattern in null_patterns.index],
+        "null_pattern_weights": null_patterns.tolist(),
+        "contact_null_rate": float(students_df["contact_info"].isna().mean()),
+        "sex": students_df["sex"].dropna().tolist(),
+        "values": {column: students_df[column].dropna().tolist() for column in NULLABLE_COLUMNS},
+        "first_names": names[0].dropna().tolist(),
+        "last_names": names[1].dropna().tolist(),
+        "streets": contact_df["street"].dropna().tolist(),
+        "cities": contact_df["city"].dropna().tolist(),
+        "states": contact_df["state"].dropna().tolist(),
+        "zips": contact_df["zip"].dropna().tolist(),
+        "email_domains": contact_df["email"].dropna().str.split("@").str[-1].tolist(),
+        "dob_range": [dob.min().date().isoformat(), dob.max().date().isoformat()],
+    }
+
+def generate_students(profile, start_uuid, count, rng):
+    patterns = np.array(profile["null_patterns"])[
+        rng.choice(len(profile["null_patterns"]), size=count, p=profile["null_pattern_weights"])]
+    columns = {"uuid": np.arange(start_uuid, start_uuid + count).tolist()}
+    for position, column in enumerate(NULLABLE_COLUMNS):
+        values = rng.choice(np.array(profile["values"][column], dtype=object), size=count)
+        columns[column] = np.where(patterns[:, position], None, values).tolist()
+
+    first = rng.choice(profile["first_names"], size=count)
+    last = rng.choice(profile["last_names"], size=count)
+    columns["name"] = [f"{first_name} {last_name}" for first_name, last_name in zip(first, last)]
+    columns["sex"] = rng.choice(profile["sex"], size=count).tolist()
+
+    dob_start = date.fromisoformat(profile["dob_range"][0])
+    dob_days = (date.fromisoformat(profile["dob_range"][1]) - dob_start).days
+    columns["dob"] = [(dob_start + timedelta(days=int(days))).isoformat()
+                      for days in rng.integers(0, dob_days + 1, size=count)]
+
+    contacts = zip(rng.choice(profile["streets"], size=count), rng.choice(profile["cities"], size=count),
+                   rng.choice(profile["states"], size=count), rng.choice(profile["zips"], size=count),
+                   rng.choice(profile["email_domains"], size=count), rng.integers(1000, 10000, size=count),
+                   first, last, rng.random(size=count))
+    columns["contact_info"] = [
+        None if missing < profile["contact_null_rate"] else json.dumps({
+            "mailing_address": f"{street}, {city}, {state}, {zip_code}",
+            "email": f"{first_name.lower()}_{last_name.lower()}{number}@{domain}"})
+        for street, city, state, zip_code, domain, number, first_name, last_name, missing in contacts]
+
+    return list(zip(*(columns[column] for column in sp.STUDENT_COLUMNS)))
+
+def generate_database(path, rows, profile, template_db, seed=0, chunk_size=100_000):
+    if os.path.exists(path):
+        os.remove(path)
+    rng = np.random.default_rng(seed)
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode=OFF")
+    con.execute("PRAGMA synchronous=OFF")
+
+    con.execute("ATTACH DATABASE ? AS template", (template_db,))
+    tables = con.execute("""SELECT name, sql FROM template.sqlite_master WHERE type = 'table'
+                            AND name IN ('cademycode_students', 'cademycode_student_jobs', 'cademycode_courses')""")
+    for name, sql in tables.fetchall():
+        con.execute(sql)
+        if name != "cademycode_students":
+            con.execute(f"INSERT INTO main.{name} SELECT * FROM template.{name}")
+    con.commit()
+    con.execute("DETACH DATABASE template")
+
+    placeholders = ", ".join("?" for _ in sp.STUDENT_COLUMNS)
+    for start in range(0, rows, chunk_size):
+        count = min(chunk_size, rows - start)
+        con.executemany(f"INSERT INTO cademycode_students VALUES ({placeholders})",
+                        generate_students(profile, start + 1, count, rng))
+        con.commit()
+    con.close()
+    return path
+
+
+def run_once(db, output_db, output_file, chunk_size=None, output_format="csv", batch_size=sp.LOAD_BATCH_SIZE,
+             transform="pandas", workers=None, shard_size=sp.SHARD_SIZE, diff_mode="hash"):
+    # Runs the shipped pipeline, checkpoints and publish step included, and reports the stage timings its
+    # PipelineMetrics recorded. Every pass is a full refresh so a rerun over unchanged data still reads and diffs
+    # every row
+    directory = os.path.dirname(os.path.abspath(output_file))
+    name = os.path.splitext(os.path.basename(output_file))[0]
+    log = os.path.join(directory, f"{name}_log.txt")
+    metrics_file = os.path.join(directory, f"{name}_metrics.jsonl")
+    succeeded = pipeline(db, output_file, output_db, log, os.path.join(directory, f"{name}_change_log.txt"),
+                         full_refresh=True, chunk_size=chunk_size, batch_size=batch_size,
+                         output_format=output_format, metrics_file=metrics_file,
+                         prometheus_file=os.path.join(directory, f"{name}.prom"), workers=workers,
+                         shard_size=shard_size, diff_mode=diff_mode, transform=transform)
+    if not succeeded:
+        raise RuntimeError(f"Pipeline run failed, see {log}")
+
+    with open(metrics_file, encoding="utf-8") as file:
+        summary = json.loads(file.readlines()[-1])
+    counters = summary["counters"]
+    total = summary["duration_seconds"]
+    return {"stages": summary["stages"],
+            "total_seconds": total,
+            "rows_per_second": round(counters.get("rows_read", 0) / total, 1) if total else None,
+            "peak_rss_mb": summary["peak_rss_mb"],
+            "rows_read": counters.get("rows_read", 0),
+            "rows_changed": counters.get("rows_inserted", 0) + counters.get("rows_updated", 0),
+            "counters": counters}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(sizes, work_dir, template_db, chunk_size=None, output_format="csv", regenerate=False,
+                  transform="pandas", workers=None, shard_size=sp.SHARD_SIZE, diff_mode="hash"):
+    os.makedirs(work_dir, exist_ok=True)
+    profile = None
+    results = []
+    for size in sizes:
+        rows = parse_size(size)
+        source_db = os.path.join(work_dir, f"cademycode_{size}.db")
+        if regenerate or not os.path.exists(source_db):
+            profile = profile or profile_source(template_db)
+            started = time.perf_counter()
+            generate_database(source_db, rows, profile, template_db)
+            print(f"Generated {rows} students in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+        output_db = os.path.join(work_dir, f"output_{size}.db")
+        if os.path.exists(output_db):
+            os.remove(output_db)
+        for run_pass in PASSES:
+            # Each pass runs in a fresh interpreter so peak RSS belongs to that pass alone
+            command = [sys.executable, os.path.abspath(__file__), "run-one", source_db, output_db,
+                       os.path.join(work_dir, f"subscriber_pipeline_{size}.csv"), "--output-format", output_format,
+                       "--transform", transform, "--shard-size", str(shard_size), "--diff-mode", diff_mode]
+            if chunk_size:
+                command += ["--chunk-size", str(chunk_size)]
+            if workers:
+                command += ["--workers", str(workers)]
+            completed = subprocess.run(command, capture_output=True, text=True, check=True)
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            result.update({"size": size, "rows": rows, "pass": run_pass})
+            results.append(result)
+            print(f"{size:>6} {run_pass:<8} {result['total_seconds']:>9.2f}s {result['peak_rss_mb']} MB",
+                  file=sys.stderr)
+
+    return {"created_at": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "chunk_size": chunk_size,
+            "output_format": output_format,
+            "transform": transform,
+            "workers": workers,
+            "shard_size": shard_size,
+            "diff_mode": diff_mode,
+            "results": results}
+
+def compare_reports(baseline, candidate):
+    lines = []
+    baseline_results = {(result["size"], result["pass"]): result for result in baseline["results"]}
+    for result in candidate["results"]:
+        previous = baseline_results.get((result["size"], result["pass"]))
+        if previous is None:
+            continue
+        for stage, seconds in list(result["stages"].items()) + [("total", result["total_seconds"])]:
+            before = previous["total_seconds"] if stage == "total" else previous["stages"].get(stage)
+            if before:
+                lines.append(f"{result['size']:>6} {result['pass']:<8} {stage:<26} "
+                             f"{before:>9.3f}s -> {seconds:>9.3f}s ({seconds / before:.2f}x)")
+        if previous.get("peak_rss_mb") and result.get("peak_rss_mb"):
+            lines.append(f"{result['size']:>6} {result['pass']:<8} {'peak_rss':<26} "
+                         f"{previous['peak_rss_mb']:>8.1f}MB -> {result['peak_rss_mb']:>8.1f}MB")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark the subscriber pipeline on synthetic data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="generate databases and time every pipeline stage")
+    run_parser.add_argument("--sizes", nargs="+", default=["10k", "100k"], help="student counts, e.g. 10k 1M")
+    run_parser.add_argument("--work-dir", default=os.path.join(here, "benchmark"))
+    run_parser.add_argument("--template-db", default=os.path.join(here, "cademycode.db"))
+    run_parser.add_argument("--report", default="benchmark_report.json")
+    run_parser.add_argument("--chunk-size", type=int, default=None)
+    run_parser.add_argument("--output-format", choices=sorted(pw.WRITERS), default="csv")
+    run_parser.add_argument("--regenerate", action="store_true", help="rebuild cached synthetic databases")
+    run_parser.add_argument("--transform", choices=["pandas", "sql"], default="pandas")
+    run_parser.add_argument("--workers", type=int, default=None)
+    run_parser.add_argument("--shard-size", type=int, default=sp.SHARD_SIZE)
+    run_parser.add_argument("--diff-mode", choices=["hash", "sql"], default="hash")
+
+    generate_parser = commands.add_parser("generate", help="only write a synthetic source database")
+    generate_parser.add_argument("size")
+    generate_parser.add_argument("path")
+    generate_parser.add_argument("--template-db", default=os.path.join(here, "cademycode.db"))
+    generate_parser.add_argument("--seed", type=int, default=0)
+
+    one_parser = commands.add_parser("run-one", help=argparse.SUPPRESS)
+    one_parser.add_argument("db")
+    one_parser.add_argument("output_db")
+    one_parser.add_argument("output_file")
+    one_parser.add_argument("--chunk-size", type=int, default=None)
+    one_parser.add_argument("--output-format", default="csv")
+    one_parser.add_argument("--transform", default="pandas")
+    one_parser.add_argument("--workers", type=int, default=None)
+    one_parser.add_argument("--shard-size", type=int, default=sp.SHARD_SIZE)
+    one_parser.add_argument("--diff-mode", default="hash")
+
+    compare_parser = commands.add_parser("compare", help="compare two benchmark reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        report = run_benchmark(args.sizes, args.work_dir, args.template_db, args.chunk_size, args.output_format,
+                               args.regenerate, args.transform, args.workers, args.shard_size, args.diff_mode)
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {args.report}")
+    elif args.command == "generate":
+        generate_database(args.path, parse_size(args.size), profile_source(args.template_db), args.template_db,
+                          args.seed)
+    elif args.command == "run-one":
+        print(json.dumps(run_once(args.db, args.output_db, args.output_file, args.chunk_size, args.output_format,
+                                  transform=args.transform, workers=args.workers, shard_size=args.shard_size,
+                                  diff_mode=args.diff_mode)))
+    else:
+        with open(args.baseline) as baseline, open(args.candidate) as candidate:
+            print(compare_reports(json.load(baseline), json.load(candidate)))
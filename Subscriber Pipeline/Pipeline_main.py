@@ -1,39 +1,459 @@
+import argparse
+import os
+import signal
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import nullcontext
+from datetime import datetime
+
+import Pipeline_metrics as pm
+import Pipeline_writers as pw
 import Subscriber_Pipeline_Functions as sp
 
-def pipeline(db, output_file, output_db, log, changelog):
-    logger = sp.setup_logger(log, changelog)
-    logger.info("***NEW RUN STARTED***")
+# Returned instead of True when a run only finished the batch of an earlier failed run
+RESUMED = "resumed"
+
+def export_frame(writer, frame, logger):
+    # Every diff path hands its changed rows over here, and load_pending applies exactly these rows later, so this
+    # is where the debug log samples the loaded rows
+    sp.log_row_sample(logger, frame, "loaded")
+    return pw.write_output(writer, frame, logger)
+
+def remove_deleted(db, plan, output_cur, output_con, source_profile, metrics, logger):
+    with metrics.stage("remove_deleted_rows"):
+        if plan["full"]:
+            return sp.stage_missing_rows(output_con, output_cur, db, logger, metrics, source_profile)
+        return sp.stage_deleted_rows(output_con, output_cur, plan["deleted"], logger, metrics)
+
+def stream_chunks(db, plan, input_cur, output_cur, output_con, writer, chunk_size, batch_size, source_profile, metrics,
+                  logger, transform="pandas"):
+    chunks = sp.extract_and_transform_chunks(input_cur, logger, plan, chunk_size, transform)
+    while True:
+        with metrics.stage("extract_and_transform_chunks"):
+            wide_chunk = next(chunks, False)
+        if wide_chunk is False:
+            break
+        if wide_chunk is None:
+            return None
+        metrics.count("rows_read", len(wide_chunk))
+
+        with metrics.stage("compare_and_update_data"):
+            final_chunk = sp.compare_and_update_data(wide_chunk, output_cur, output_con, logger, detect_deletes=False,
+                                                     batch_size=batch_size, metrics=metrics, apply=False)
+        if final_chunk is None:
+            return None
+
+        with metrics.stage("export"):
+            if export_frame(writer, final_chunk, logger) is None:
+                return None
+
+    return remove_deleted(db, plan, output_cur, output_con, source_profile, metrics, logger)
+
+def run_shards(db, output_db, plan, input_cur, output_cur, output_con, writer, workers, shard_size, batch_size,
+               source_profile, metrics, logger, transform="pandas"):
+    with metrics.stage("shard_ranges"):
+        shards = sp.shard_ranges(input_cur, plan, shard_size, logger)
+    if shards is None:
+        return None
+
+    shards = iter(shards)
+    pending = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Keep a couple of shards queued per worker without holding every finished diff in memory
+            for shard in shards:
+                pending[executor.submit(sp.diff_shard, db, output_db, plan, shard, source_profile, transform)] = shard
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            with metrics.stage("diff_shard"):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                low, high = pending.pop(future)
+                try:
+                    diff = future.result()
+                except Exception as e:
+                    logger.error(f"Failed to transform shard {low}-{high} with error:\n{e}")
+                    executor.shutdown(cancel_futures=True)
+                    return None
+                metrics.count("rows_read", diff["rows"])
+
+                final_shard = sp.load_diff(diff, diff["rows"], output_con, output_cur, logger, batch_size, metrics,
+                                           apply=False)
+                if final_shard is None:
+                    executor.shutdown(cancel_futures=True)
+                    return None
+
+                with metrics.stage("export"):
+                    if export_frame(writer, final_shard, logger) is None:
+                        executor.shutdown(cancel_futures=True)
+                        return None
+
+    return remove_deleted(db, plan, output_cur, output_con, source_profile, metrics, logger)
+
+def run_sql_diff(db, plan, input_cur, output_cur, output_con, writer, chunk_size, batch_size, source_profile, metrics,
+                 logger, transform="pandas"):
+    # Transformed rows only go one way, into a temp table on the output connection, the diff itself is SQL
+    sp.create_staging_table(output_cur)
+    if transform == "sql":
+        with metrics.stage("stage_transformed"):
+            staged = sp.stage_transformed(output_con, output_cur, db, plan, logger, source_profile)
+        if staged is None:
+            return None
+        metrics.count("rows_read", staged)
+        frames = iter([])
+    elif chunk_size:
+        frames = sp.extract_and_transform_chunks(input_cur, logger, plan, chunk_size)
+    else:
+        frames = iter([sp.extract_and_transform_data(input_cur, logger, plan)])
+    while True:
+        with metrics.stage("extract_and_transform_data"):
+            wide_df = next(frames, False)
+        if wide_df is False:
+            break
+        if wide_df is None:
+            return None
+        metrics.count("rows_read", len(wide_df))
+        with metrics.stage("stage_rows"):
+            if sp.stage_rows(wide_df, output_con, output_cur, logger, batch_size) is None:
+                return None
+
+    # The changed rows come back chunk_size at a time, each one exported before the next is read
+    changes = sp.sql_diff_load(output_con, output_cur, logger, metrics, apply=False, chunksize=chunk_size)
+    while True:
+        with metrics.stage("sql_diff_load"):
+            final_data = next(changes, False)
+        if final_data is False:
+            break
+        if final_data is None:
+            return None
+        with metrics.stage("export"):
+            if export_frame(writer, final_data, logger) is None:
+                return None
+    return remove_deleted(db, plan, output_cur, output_con, source_profile, metrics, logger)
+
+def diff_changes(db, output_db, plan, input_cur, output_cur, output_con, writer, chunk_size, batch_size, workers,
+                 shard_size, diff_mode, source_profile, metrics, logger, transform="pandas"):
+    if workers:
+        return run_shards(db, output_db, plan, input_cur, output_cur, output_con, writer, workers, shard_size,
+                          batch_size, source_profile, metrics, logger, transform)
+    if diff_mode == "sql":
+        return run_sql_diff(db, plan, input_cur, output_cur, output_con, writer, chunk_size, batch_size,
+                            source_profile, metrics, logger, transform)
+    if chunk_size:
+        return stream_chunks(db, plan, input_cur, output_cur, output_con, writer, chunk_size, batch_size,
+                             source_profile, metrics, logger, transform)
 
-    input_con = sp.connect_to_database(db, logger)
-    output_con = sp.connect_to_database(output_db, logger)
+    with metrics.stage("extract_and_transform_data"):
+        wide_df = sp.extract_and_transform_data(input_cur, logger, plan, transform)
+    if wide_df is None:
+        return None
+    metrics.count("rows_read", len(wide_df))
+
+    with metrics.stage("compare_and_update_data"):
+        final_data = sp.compare_and_update_data(wide_df, output_cur, output_con, logger, detect_deletes=plan["full"],
+                                                deleted_uuids=plan["deleted"], batch_size=batch_size, metrics=metrics,
+                                                apply=False)
+    if final_data is None:
+        return None
+
+    with metrics.stage("export"):
+        return export_frame(writer, final_data, logger)
+
+def stage_changes(db, output_db, plan, output_file, output_format, input_cur, output_cur, output_con, chunk_size,
+                  batch_size, workers, shard_size, diff_mode, source_profile, metrics, logger, transform="pandas"):
+    # Every change the run finds goes into students_pending in one transaction, and into the hidden temp export,
+    # committed together with the "diffed" checkpoint once the export is complete. A failure before that commit
+    # leaves the output DB as it was and removes the partial export
+    writer = pw.open_writer(output_format, output_file, logger, metrics.run_id)
+    if writer is None:
+        return None
+    needs_source = (diff_mode == "sql" and transform == "sql" or
+                    plan["full"] and (workers or diff_mode == "sql" or chunk_size))
+    committed = False
+    try:
+        with sp.attached(output_con, db, "source", source_profile) if needs_source else nullcontext():
+            output_cur.execute("BEGIN")
+            sp.clear_pending(output_cur)
+            if diff_changes(db, output_db, plan, input_cur, output_cur, output_con, writer, chunk_size, batch_size,
+                            workers, shard_size, diff_mode, source_profile, metrics, logger, transform) is None:
+                return None
+            with metrics.stage("export"):
+                if pw.close_writer(writer, logger) is None:
+                    return None
+            metrics.count("bytes_written", pw.output_size(writer.path))
+            sp.save_checkpoint(output_cur, metrics.run_id, "diffed", plan, metrics.counters, output_format,
+                               output_file)
+            output_con.commit()
+            committed = True
+        logger.info(f"Run {metrics.run_id} checkpointed after the diff")
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to checkpoint the diffed changes with error:\n{e}")
+        return None
+
+    finally:
+        if output_con.in_transaction:
+            output_con.rollback()
+        if not committed:
+            pw.discard_output(writer, logger)
+
+def export_changes(output_con, output_file, output_format, chunk_size, metrics, logger):
+    # Only needed when a resumed run finds no complete export from the diff, the staged changes are written again
+    with metrics.stage("export"):
+        writer = pw.open_writer(output_format, output_file, logger, metrics.run_id)
+        if writer is None:
+            return None
+        for frame in sp.pending_frames(output_con, logger, chunk_size):
+            if frame is None or pw.write_output(writer, frame, logger) is None:
+                pw.discard_output(writer, logger)
+                return None
+        if pw.close_writer(writer, logger) is None:
+            pw.discard_output(writer, logger)
+            return None
+    metrics.count("bytes_written", pw.output_size(writer.path))
+    return True
+
+def run_pipeline(db, output_file, output_db, logger, metrics, full_refresh=False, track_changes=False,
+                 chunk_size=None, batch_size=sp.LOAD_BATCH_SIZE, output_format="csv", workers=None,
+                 shard_size=sp.SHARD_SIZE, without_rowid=False, diff_mode="hash", immutable_source=False,
+                 transform="pandas", publish_dir=None):
+    if workers and ":memory:" in (db, output_db):
+        logger.error("Parallel runs need file databases, worker processes cannot open :memory:")
+        return None
+    if workers and diff_mode == "sql":
+        logger.error("The SQL diff runs on the single output connection, it cannot be combined with --workers")
+        return None
+    if diff_mode == "sql" and transform == "sql" and db == ":memory:":
+        logger.error("The SQL transform stages from the source attached to the output DB, which needs a file source")
+        return None
+    if immutable_source and track_changes:
+        logger.error("An immutable source cannot have change tracking triggers, drop one of the two options")
+        return None
+    source_profile = "snapshot" if immutable_source else "reader"
+
+    if track_changes:
+        # The source profiles are read-only, so the triggers go in over a short-lived writable connection
+        tracking_con = sp.connect_to_database(db, logger)
+        if tracking_con is None:
+            return None
+        installed = sp.install_change_tracking(tracking_con, tracking_con.cursor(), logger)
+        tracking_con.close()
+        if installed is None:
+            return None
+
+    with metrics.stage("connect_to_database"):
+        input_con = sp.connect_to_database(db, logger, source_profile, reuse=True)
+        output_con = sp.connect_to_database(output_db, logger, "output", reuse=True)
 
     if not input_con or not output_con:
-        return
+        return None
 
     input_cur = input_con.cursor()
     output_cur = output_con.cursor()
 
-    wide_df = sp.extract_and_transform_data(input_cur,logger)
-    if wide_df is None:
-        return
+    with metrics.stage("intialize_output_db"):
+        if sp.intialize_output_db(output_con, output_cur, logger, without_rowid) is None:
+            return None
+    # Worker processes read the hash table through their own connections, so it has to be committed first
+    sp.ensure_hash_table(output_cur)
+    output_con.commit()
 
-    if sp.intialize_output_db(output_con, output_cur, logger) is None:
-        return
+    checkpoint = sp.read_checkpoint(output_cur, logger)
+    if checkpoint is None:
+        return None
+    if checkpoint:
+        # The last run failed after its diff was committed: its batch is finished from the checkpoint instead of
+        # extracting, transforming and diffing again
+        logger.warning(f"Resuming run {checkpoint['run_id']} from its '{checkpoint['stage']}' checkpoint")
+        metrics.run_id = checkpoint["run_id"]
+        for name, value in checkpoint["counters"].items():
+            metrics.count(name, value)
+        plan, output_file, output_format = checkpoint["plan"], checkpoint["output_file"], checkpoint["output_format"]
+        stage = checkpoint["stage"]
+    else:
+        with metrics.stage("plan_extraction"):
+            plan = sp.plan_extraction(input_cur, output_cur, logger, full_refresh)
+        if plan is None:
+            return None
+        if stage_changes(db, output_db, plan, output_file, output_format, input_cur, output_cur, output_con,
+                         chunk_size, batch_size, workers, shard_size, diff_mode, source_profile, metrics, logger,
+                         transform) is None:
+            return None
+        stage = "diffed"
 
-    final_data = sp.compare_and_update_data(wide_df, output_cur, output_con, logger)
+    if stage == "diffed":
+        # The export is complete before the load commits, so a committed load always has it waiting beside it
+        if checkpoint and not os.path.exists(pw.temp_output_path(pw.output_path(output_file, output_format))):
+            if export_changes(output_con, output_file, output_format, chunk_size, metrics, logger) is None:
+                return None
+        with metrics.stage("load_students_analysis"):
+            if sp.load_pending(output_con, output_cur, plan, logger, metrics) is None:
+                return None
 
-    if final_data is None:
-        return
+    with metrics.stage("publish"):
+        if pw.replace_output(output_file, output_format, logger) is None:
+            return None
+        # Each run's export is moved out before the next run writes its own. It is published before the checkpoint
+        # is closed, so a failed move is retried by the resume (an export already moved away is not looked for)
+        path = pw.output_path(output_file, output_format)
+        if publish_dir and os.path.exists(path):
+            if pw.publish_output(path, publish_dir, datetime.now().strftime("%Y-%m-%d-%H%M%S%f"), logger) is None:
+                return None
+        if sp.finish_checkpoint(output_con, output_cur, metrics.run_id, logger) is None:
+            return None
+    return RESUMED if checkpoint else True
 
-    sp.generate_csv(final_data, output_file, logger)
+def pipeline(db, output_file, output_db, log, changelog, full_refresh=False, track_changes=False, chunk_size=None,
+             batch_size=sp.LOAD_BATCH_SIZE, output_format="csv", metrics_file=None, prometheus_file=None, workers=None,
+             shard_size=sp.SHARD_SIZE, without_rowid=False, debug_log=None, debug_sample_rate=0.01, diff_mode="hash",
+             immutable_source=False, transform="pandas", keep_connections=False, publish_dir=None):
+    logger = sp.setup_logger(log, changelog, background=True, debug_file=debug_log,
+                             debug_sample_rate=debug_sample_rate)
+    logger.info("***NEW RUN STARTED***")
+
+    while True:
+        metrics = pm.PipelineMetrics()
+        succeeded = None
+        try:
+            succeeded = run_pipeline(db, output_file, output_db, logger, metrics, full_refresh, track_changes,
+                                     chunk_size, batch_size, output_format, workers, shard_size, without_rowid,
+                                     diff_mode, immutable_source, transform, publish_dir)
+        finally:
+            metrics.finish(succeeded)
+            sp.record_run(output_db, metrics, logger)
+            default_metrics_file, default_prometheus_file = pm.default_metrics_files(changelog)
+            pm.write_metrics(metrics, metrics_file or default_metrics_file, logger,
+                             prometheus_file or default_prometheus_file)
+            # A failed run never leaves its connections (or a half-done transaction on them) to the next one
+            if not keep_connections or not succeeded:
+                sp.close_connections()
+            sp.flush_logger(logger)
+        if succeeded != RESUMED:
+            return succeeded
+        # The resumed run only finished an earlier batch, the source changes made since still need a run of their own
+        logger.info("Resumed run finished, starting a new run for the current source changes")
 
-    input_con.close()
-    output_con.close()
+def daemon(db, output_file, output_db, log, changelog, interval=10.0, publish_dir=None, max_cycles=None, stop=None,
+           **options):
+    # One resident process: pooled connections, the course lookup cache and the imports stay warm, and an
+    # incremental cycle only runs when the source DB changed since the last successful one
+    logger = sp.setup_logger(log, changelog, background=True, debug_file=options.get("debug_log"),
+                             debug_sample_rate=options.get("debug_sample_rate", 0.01))
+    if options.get("immutable_source"):
+        logger.error("An immutable source is never re-read, it cannot be watched in daemon mode")
+        return None
+    stop = stop or threading.Event()
+    watcher = None
+    last = None
+    cycles = 0
+    logger.info(f"Daemon watching {db} every {interval}s")
+    try:
+        while not stop.is_set() and (max_cycles is None or cycles < max_cycles):
+            try:
+                watcher = watcher or sp.open_connection(db, "reader")
+                signature = sp.source_signature(watcher, db)
+            except Exception as e:
+                logger.error(f"Failed to check the source DB with error:\n{e}")
+                stop.wait(interval)
+                continue
+
+            if last is not None and signature[0] != last[0]:
+                # The file was replaced, connections still open on the old one would never see the new data
+                logger.info("Source DB file replaced, reopening connections")
+                sp.close_connections()
+                watcher.close()
+                watcher = None
+                continue
+            if signature != last:
+                cycles += 1
+                if pipeline(db, output_file, output_db, log, changelog, keep_connections=True,
+                            publish_dir=publish_dir, **options):
+                    # Checked again straight away, in case the source changed while the cycle ran
+                    last = signature
+                    continue
+                # A failed cycle leaves the mark where it was, so it is retried on the next tick
+            stop.wait(interval)
+    finally:
+        if watcher is not None:
+            watcher.close()
+        sp.close_connections()
+        logger.info(f"Daemon stopped after {cycles} cycles")
+        sp.flush_logger(logger)
+    return cycles
 
 
 db = r"C:\Users\oltho\Documents\Data Engineer Career Path (Code Academy)\DE Portfolio Project\dev\dev\cademycode_updated.db"
-csv = r"C:\Users\oltho\Documents\Data Engineer Career Path (Code Academy)\DE Portfolio Project\dev\dev\subscriber_pipleline.csv"
+csv = r"C:\Users\oltho\Documents\Data Engineer Career Path (Code Academy)\DE Portfolio Project\dev\dev\subscriber_pipeline.csv"
 log = r"C:\Users\oltho\Documents\Data Engineer Career Path (Code Academy)\DE Portfolio Project\dev\dev\subscriber_pipleline_log.txt"
 output_db = r"C:\Users\oltho\Documents\Data Engineer Career Path (Code Academy)\DE Portfolio Project\dev\dev\output.db"
 change_log = r"C:\Users\oltho\Documents\Data Engineer Career Path (Code Academy)\DE Portfolio Project\dev\dev\subscriber_change_log.txt"
-pipeline(db, csv, output_db, log, change_log)
\ No newline at end of file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the subscriber pipeline")
+    parser.add_argument("--full-refresh", action="store_true",
+                        help="ignore the saved watermarks and re-extract every source row")
+    parser.add_argument("--track-changes", action="store_true",
+                        help="install triggers on the source DB so updated and deleted students are picked up")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="stream students through the pipeline this many rows at a time to cap memory use")
+    parser.add_argument("--batch-size", type=int, default=sp.LOAD_BATCH_SIZE,
+                        help="rows per executemany batch when loading students_analysis")
+    parser.add_argument("--output-format", choices=sorted(pw.WRITERS), default="csv",
+                        help="format of the exported changes; parquet is partitioned by run date and career path")
+    parser.add_argument("--metrics-file", default=None,
+                        help="JSON-lines run metrics (default: subscriber_metrics.jsonl next to the change log)")
+    parser.add_argument("--prometheus-file", default=None,
+                        help="Prometheus textfile-collector output (default: subscriber_pipeline.prom next to the "
+                             "change log)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="extract, transform and diff uuid shards in this many worker processes; the main "
+                             "process stays the only writer to the output DB")
+    parser.add_argument("--shard-size", type=int, default=sp.SHARD_SIZE,
+                        help="students per uuid shard when running with --workers")
+    parser.add_argument("--without-rowid", action="store_true",
+                        help="create students_analysis as a WITHOUT ROWID table (only when the table is first built "
+                             "or upgraded)")
+    parser.add_argument("--debug-log", default=None,
+                        help="write a sample of individual rows (transformed and loaded) to this file")
+    parser.add_argument("--debug-sample-rate", type=float, default=0.01,
+                        help="fraction of rows written to --debug-log")
+    parser.add_argument("--diff-mode", choices=["hash", "sql"], default="hash",
+                        help="hash: compare row hashes in pandas; sql: stage the transformed rows in a temp table and "
+                             "diff them against students_analysis with EXCEPT inside sqlite")
+    parser.add_argument("--immutable-source", action="store_true",
+                        help="open the source DB with immutable=1 (no locking or change checks); only for snapshot "
+                             "files that nothing writes to during the run")
+    parser.add_argument("--transform", choices=["pandas", "sql"], default="pandas",
+                        help="pandas: build the wide table in DataFrames; sql: push the join, null fill, type coercion "
+                             "and contact parsing down into one sqlite query")
+    parser.add_argument("--daemon", action="store_true",
+                        help="stay resident, check the source DB every --interval seconds and run an incremental "
+                             "cycle whenever it changed")
+    parser.add_argument("--interval", type=float, default=10.0,
+                        help="seconds between source DB checks in --daemon mode")
+    parser.add_argument("--publish-dir", default=None,
+                        help="move each run's export into a timestamped directory here, renamed into place only once "
+                             "complete (a resumed run and the run that follows it are published separately)")
+    args = parser.parse_args()
+    options = dict(full_refresh=args.full_refresh, track_changes=args.track_changes,
+                   chunk_size=args.chunk_size, batch_size=args.batch_size,
+                   output_format=args.output_format, metrics_file=args.metrics_file,
+                   prometheus_file=args.prometheus_file, workers=args.workers, shard_size=args.shard_size,
+                   without_rowid=args.without_rowid, debug_log=args.debug_log,
+                   debug_sample_rate=args.debug_sample_rate, diff_mode=args.diff_mode,
+                   immutable_source=args.immutable_source, transform=args.transform)
+    if args.daemon:
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        try:
+            daemon(db, csv, output_db, log, change_log, args.interval, args.publish_dir, stop=stop, **options)
+        except KeyboardInterrupt:
+            pass
+    else:
+        # A non-zero exit tells run.sh the run failed, its output stays where it is for the resume
+        sys.exit(0 if pipeline(db, csv, output_db, log, change_log, publish_dir=args.publish_dir, **options) else 1)
@@ -0,0 +1,132 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def current_rss_mb():
+    # Resident memory right now, unlike ru_maxrss which only ever grows over the life of the process
+    try:
+        with open("/proc/self/statm") as file:
+            pages = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def stage(metrics, name):
+    return metrics.stage(name) if metrics is not None else nullcontext()
+
+def count(metrics, name, value=1):
+    if metrics is not None:
+        metrics.count(name, value)
+
+def run_id(metrics):
+    return metrics.run_id if metrics is not None else None
+
+
+class PipelineMetrics:
+    def __init__(self, run_id=None):
+        self.started_at = datetime.now()
+        self.run_id = run_id or self.started_at.strftime("%Y%m%d%H%M%S%f")
+        self.stages = {}
+        self.stage_rss_delta_mb = {}
+        self.counters = {}
+        self.status = "running"
+        self.duration = None
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        rss_before = current_rss_mb()
+        try:
+            yield
+        finally:
+            # Stages that run once per chunk accumulate into one total, and keep the largest memory change of any
+            # one call
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+            rss_after = current_rss_mb()
+            if rss_before is not None and rss_after is not None:
+                delta = rss_after - rss_before
+                self.stage_rss_delta_mb[name] = max(delta, self.stage_rss_delta_mb.get(name, delta))
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self, succeeded):
+        self.status = "success" if succeeded else "failed"
+        self.duration = time.perf_counter() - self.started
+
+    def as_dict(self):
+        return {"run_id": self.run_id,
+                "started_at": self.started_at.isoformat(timespec="seconds"),
+                "status": self.status,
+                "duration_seconds": round(self.duration or time.perf_counter() - self.started, 4),
+                "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+                "stage_rss_delta_mb": {name: round(delta, 1) for name, delta in self.stage_rss_delta_mb.items()},
+                "counters": self.counters,
+                "peak_rss_mb": peak_rss_mb()}
+
+    def prometheus_lines(self):
+        summary = self.as_dict()
+        lines = ["# HELP subscriber_pipeline_stage_seconds Wall-clock seconds spent in each stage of the last run",
+                 "# TYPE subscriber_pipeline_stage_seconds gauge"]
+        lines += [f'subscriber_pipeline_stage_seconds{{stage="{name}"}} {seconds}'
+                  for name, seconds in summary["stages"].items()]
+        lines += ["# HELP subscriber_pipeline_rows Rows handled by the last run",
+                  "# TYPE subscriber_pipeline_rows gauge"]
+        lines += [f'subscriber_pipeline_rows{{kind="{name[len("rows_"):]}"}} {value}'
+                  for name, value in summary["counters"].items() if name.startswith("rows_")]
+        lines += ["# HELP subscriber_pipeline_bytes_written Bytes written to the exported output by the last run",
+                  "# TYPE subscriber_pipeline_bytes_written gauge",
+                  f"subscriber_pipeline_bytes_written {summary['counters'].get('bytes_written', 0)}",
+                  "# HELP subscriber_pipeline_duration_seconds Wall-clock seconds of the last run",
+                  "# TYPE subscriber_pipeline_duration_seconds gauge",
+                  f"subscriber_pipeline_duration_seconds {summary['duration_seconds']}",
+                  "# HELP subscriber_pipeline_last_run_success 1 if the last run succeeded, 0 otherwise",
+                  "# TYPE subscriber_pipeline_last_run_success gauge",
+                  f"subscriber_pipeline_last_run_success {int(self.status == 'success')}",
+                  "# HELP subscriber_pipeline_last_run_timestamp_seconds Unix time the last run started",
+                  "# TYPE subscriber_pipeline_last_run_timestamp_seconds gauge",
+                  f"subscriber_pipeline_last_run_timestamp_seconds {self.started_at.timestamp():.0f}"]
+        if summary["peak_rss_mb"] is not None:
+            lines += ["# HELP subscriber_pipeline_peak_rss_bytes Peak resident memory of the pipeline process so far",
+                      "# TYPE subscriber_pipeline_peak_rss_bytes gauge",
+                      f"subscriber_pipeline_peak_rss_bytes {int(summary['peak_rss_mb'] * 1024 * 1024)}"]
+        return lines
+
+
+def default_metrics_files(changelog_file):
+    directory = os.path.dirname(os.path.abspath(changelog_file))
+    return (os.path.join(directory, "subscriber_metrics.jsonl"),
+            os.path.join(directory, "subscriber_pipeline.prom"))
+
+def write_metrics(metrics, metrics_file, logger, prometheus_file=None):
+    try:
+        with open(metrics_file, "a", encoding="utf-8") as file:
+            file.write(json.dumps(metrics.as_dict()) + "\n")
+
+        if prometheus_file:
+            # The textfile collector may read at any time, so replace the file in one step
+            temp_file = prometheus_file + ".tmp"
+            with open(temp_file, "w", encoding="utf-8") as file:
+                file.write("\n".join(metrics.prometheus_lines()) + "\n")
+            os.replace(temp_file, prometheus_file)
+
+        logger.info(f"Run metrics written to {metrics_file}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to write run metrics with error:\n{e}")
+        return None
@@ -0,0 +1,220 @@
+import gzip
+import io
+import os
+import shutil
+from datetime import date, datetime
+from urllib.parse import quote
+
+import pandas as pd
+
+import Subscriber_Pipeline_Functions as sp
+
+DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+def arrow_schema():
+    import pyarrow as pa
+
+    types = {"uuid": pa.int64(), "job_id": pa.int64(), "num_course_taken": pa.float64(),
+             "current_career_path_id": pa.float64(), "time_spent_hrs": pa.float64(),
+             "hours_to_complete": pa.float64()}
+    return pa.schema([(column, types.get(column, pa.string())) for column in sp.ANALYSIS_COLUMNS])
+
+def arrow_table(data, schema):
+    import pyarrow as pa
+
+    return pa.Table.from_pandas(sp.plain_dtypes(data[schema.names]), schema=schema, preserve_index=False)
+
+
+class CsvWriter:
+    def __init__(self, path, compression=None):
+        self.path = path
+        self.rows = 0
+        if compression == "gzip":
+            self.file = gzip.open(path, "wt", encoding="utf-8", newline="")
+        elif compression == "zstd":
+            import zstandard
+
+            raw = open(path, "wb")
+            self.file = io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw), encoding="utf-8", newline="")
+        else:
+            self.file = open(path, "w", encoding="utf-8", newline="")
+
+    def write(self, data):
+        if self.rows == 0 and data.empty:
+            return
+        sp.plain_dtypes(data).to_csv(self.file, index=False, header=self.rows == 0)
+        self.rows += len(data)
+
+    def close(self):
+        if self.rows == 0:
+            self.file.write(",".join(sp.ANALYSIS_COLUMNS) + "\n")
+        self.file.close()
+
+
+class ParquetWriter:
+    # Hive style layout: <path>/run_date=YYYY-MM-DD/career_path_name=<name>/part-<run_id>.parquet,
+    # with one row group per written chunk. The part files are named after the run, so every run of the day adds its
+    # own files to the run_date partition instead of overwriting the earlier runs' ones
+    def __init__(self, path, run_date=None, run_id=None):
+        self.path = path
+        self.run_date = (run_date or date.today()).isoformat()
+        self.part = f"part-{run_id or datetime.now().strftime('%Y%m%d%H%M%S%f')}.parquet"
+        self.schema = arrow_schema()
+        self.file_schema = self.schema.remove(self.schema.get_field_index("career_path_name"))
+        self.writers = {}
+        self.rows = 0
+
+    def partition_writer(self, partition):
+        import pyarrow.parquet as pq
+
+        if partition not in self.writers:
+            directory = os.path.join(self.path, f"run_date={self.run_date}", f"career_path_name={partition}")
+            os.makedirs(directory, exist_ok=True)
+            self.writers[partition] = pq.ParquetWriter(os.path.join(directory, self.part),
+                                                       self.file_schema, compression="zstd")
+        return self.writers[partition]
+
+    def write(self, data):
+        for career_path_name, group in data.groupby("career_path_name", dropna=False, sort=False):
+            partition = DEFAULT_PARTITION if pd.isna(career_path_name) else quote(str(career_path_name), safe="")
+            table = arrow_table(group, self.schema).drop_columns(["career_path_name"])
+            self.partition_writer(partition).write_table(table)
+        self.rows += len(data)
+
+    def close(self):
+        os.makedirs(os.path.join(self.path, f"run_date={self.run_date}"), exist_ok=True)
+        for writer in self.writers.values():
+            writer.close()
+
+
+class ArrowWriter:
+    def __init__(self, path):
+        import pyarrow as pa
+
+        self.path = path
+        self.schema = arrow_schema()
+        self.sink = pa.OSFile(path, "wb")
+        self.writer = pa.ipc.new_file(self.sink, self.schema)
+        self.rows = 0
+
+    def write(self, data):
+        for batch in arrow_table(data, self.schema).to_batches():
+            self.writer.write_batch(batch)
+        self.rows += len(data)
+
+    def close(self):
+        self.writer.close()
+        self.sink.close()
+
+
+WRITERS = {
+    "csv": (".csv", lambda path, run_id: CsvWriter(path)),
+    "csv.gz": (".csv.gz", lambda path, run_id: CsvWriter(path, compression="gzip")),
+    "csv.zst": (".csv.zst", lambda path, run_id: CsvWriter(path, compression="zstd")),
+    "parquet": ("", lambda path, run_id: ParquetWriter(path, run_id=run_id)),
+    "arrow": (".arrow", lambda path, run_id: ArrowWriter(path)),
+}
+
+def output_path(output_file, output_format):
+    suffix = WRITERS[output_format][0]
+    return os.path.splitext(output_file)[0] + suffix
+
+def output_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(directory, name))
+                   for directory, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def temp_output_path(path):
+    # Hidden sibling the export is written to, renamed over path by replace_output once the run has committed
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.tmp")
+
+def remove_output(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def open_writer(output_format, output_file, logger, run_id=None):
+    try:
+        path = output_path(output_file, output_format)
+        remove_output(temp_output_path(path))
+        writer = WRITERS[output_format][1](temp_output_path(path), run_id)
+        logger.info(f"Writing {output_format} output to {path}")
+        return writer
+
+    except Exception as e:
+        logger.error(f"Failed to open {output_format} output with error:\n{e}")
+        return None
+
+def write_output(writer, data, logger):
+    try:
+        writer.write(data)
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to write output with error:\n{e}")
+        return None
+
+def close_writer(writer, logger):
+    try:
+        writer.close()
+        logger.info(f"Data exported, {writer.rows} rows submitted.")
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to close output with error:\n{e}")
+        return None
+
+def discard_output(writer, logger):
+    try:
+        writer.close()
+    except Exception:
+        pass
+    try:
+        remove_output(writer.path)
+    except Exception as e:
+        logger.error(f"Failed to remove partial output {writer.path} with error:\n{e}")
+
+def replace_output(output_file, output_format, logger):
+    # Files are moved with os.replace, so a reader sees either the previous export or the complete new one. The parquet
+    # run's part files are moved into the dataset one by one: each appears complete, but a reader listing the dataset
+    # mid-move can see some of the run's partitions before the rest. Earlier runs' part files are never touched
+    path = output_path(output_file, output_format)
+    temp = temp_output_path(path)
+    try:
+        if not os.path.exists(temp):
+            logger.info(f"No staged output for {path}, it was already moved into place")
+            return path
+        if os.path.isdir(temp):
+            for directory, _, names in os.walk(temp):
+                target = os.path.join(path, os.path.relpath(directory, temp))
+                os.makedirs(target, exist_ok=True)
+                for name in names:
+                    os.replace(os.path.join(directory, name), os.path.join(target, name))
+            shutil.rmtree(temp)
+        else:
+            os.replace(temp, path)
+        logger.info(f"Output moved into place at {path}")
+        return path
+
+    except Exception as e:
+        logger.error(f"Failed to move output into place at {path} with error:\n{e}")
+        return None
+
+def publish_output(path, publish_dir, name, logger):
+    # The export is moved into a hidden staging directory first and only renamed to its final name once complete,
+    # so readers of publish_dir never see a partial run (skip names starting with ".")
+    try:
+        staging = os.path.join(publish_dir, f".{name}.tmp")
+        target = os.path.join(publish_dir, name)
+        os.makedirs(staging)
+        shutil.move(path, os.path.join(staging, os.path.basename(path)))
+        os.replace(staging, target)
+        logger.info(f"Published {path} to {target}")
+        return target
+
+    except Exception as e:
+        logger.error(f"Failed to publish {path} with error:\n{e}")
+        return None
@@ -3,12 +3,30 @@ import logging
 import sys
 from io import StringIO
 import unittest.mock as mock
+import importlib.util
 from unittest.mock import MagicMock, mock_open, patch
 
 
 import pandas as pd
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from Pipeline_main import pipeline, daemon
+from Pipeline_writers import open_writer, write_output, close_writer, replace_output, output_path
+from Pipeline_benchmark import profile_source, generate_database, run_once
+from Pipeline_metrics import PipelineMetrics
 from Subscriber_Pipeline_Functions import (setup_logger, connect_to_database, extract_and_transform_data,
-                                           intialize_output_db, compare_and_update_data, generate_csv)
+                                           intialize_output_db, compare_and_update_data, generate_csv,
+                                           install_change_tracking, plan_extraction, save_watermarks,
+                                           extract_and_transform_chunks, load_students_analysis,
+                                           parse_contact_info, clean_students, read_dimensions, build_wide_df,
+                                           ANALYSIS_COLUMNS, SCHEMA_VERSION, apply_migrations,
+                                           close_logger, flush_logger, log_row_sample, open_connection,
+                                           attach_database, attached, hash_rows, compact_dtypes, plain_dtypes,
+                                           to_records)
 
 class LoggerTestClass(unittest.TestCase):
     def setUp(self):
@@ -50,6 +68,34 @@ class LoggerTestClass(unittest.TestCase):
             changelog_contents = changelog_file.read()
             self.assertIn("Test warning message", changelog_contents)
 
+    def test_setup_logger_is_idempotent(self):
+        logger = setup_logger(self.log_file, self.changelog_file, logger_name='test_idempotent')
+        handlers = list(logger.handlers)
+        self.assertIs(setup_logger(self.log_file, self.changelog_file, logger_name='test_idempotent'), logger)
+        self.assertEqual(logger.handlers, handlers)
+        close_logger(logger)
+        self.assertEqual(logger.handlers, [])
+
+    def test_background_logger_with_row_sample(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            debug_file = os.path.join(tmp_dir, "rows.log")
+            sys.stdout = StringIO()
+            logger = setup_logger(self.log_file, self.changelog_file, logger_name='test_background', background=True,
+                                  debug_file=debug_file, debug_sample_rate=1.0)
+            self.assertEqual([type(handler).__name__ for handler in logger.handlers], ['QueueHandler'])
+
+            logger.info("Queued info message")
+            log_row_sample(logger, pd.DataFrame({'uuid': [1, 2], 'name': ['Alice', 'Bob']}), "transformed")
+            flush_logger(logger)
+            close_logger(logger)
+
+            with open(self.log_file, 'r') as log_file:
+                log_contents = log_file.read()
+            self.assertIn("Queued info message", log_contents)
+            self.assertNotIn("uuid=1", log_contents)
+            with open(debug_file, 'r') as rows_file:
+                self.assertEqual(rows_file.read().count("transformed uuid="), 2)
+
 
 
 class TestClass(unittest.TestCase):
@@ -123,9 +169,39 @@ class TestClass(unittest.TestCase):
 
         test_df = pd.DataFrame(columns=['uuid', 'name', 'dob', 'sex', 'contact_info', 'job_id', 'num_course_taken',
                                         'current_career_path_id', 'time_spent_hrs', 'career_path_name',
-                                        'hours_to_complete'])
+                                        'hours_to_complete', 'mailing_address', 'email', 'street', 'city', 'state',
+                                        'zip'])
         assert test_df.shape[1] == wide_df.shape[1], "Dataframes have different shapes"
 
+    def test_parse_contact_info(self):
+        contact_info = pd.Series(['{"mailing_address": "303 N Timber Key, Irondale, Wisconsin, 84736", '
+                                  '"email": "annabelle_avery9376@woohoo.com"}', None, '1234567890', "{'bad': 1}"])
+        contact_df = parse_contact_info(contact_info)
+
+        self.assertEqual(contact_df.loc[0, 'email'], 'annabelle_avery9376@woohoo.com')
+        self.assertEqual(contact_df.loc[0, 'street'], '303 N Timber Key')
+        self.assertEqual(contact_df.loc[0, 'city'], 'Irondale')
+        self.assertEqual(contact_df.loc[0, 'state'], 'Wisconsin')
+        self.assertEqual(contact_df.loc[0, 'zip'], '84736')
+        self.assertTrue(contact_df.loc[1:].isna().all().all(), "Null, non-object and malformed values parse to NA")
+
+    def test_parse_contact_info_keeps_rows_apart(self):
+        contact_info = pd.Series(['{"email":"a@x"}, {"email":"b@x"}', '[3', '4]'])
+        contact_df = parse_contact_info(contact_info)
+
+        self.assertTrue(contact_df.isna().all().all(), "Fragments that only parse when joined stay NA")
+
+    def test_clean_students_coerces_numbers(self):
+        students_df = pd.DataFrame([[1, 'A', '1990-01-01', 'F', None, None, '3.0', '2.0', 'n/a']],
+                                   columns=['uuid', 'name', 'dob', 'sex', 'contact_info', 'job_id',
+                                            'num_course_taken', 'current_career_path_id', 'time_spent_hrs'])
+        cleaned = clean_students(students_df)
+
+        self.assertEqual(cleaned.loc[0, 'job_id'], 99)
+        self.assertEqual(str(cleaned['job_id'].dtype), 'Int64')
+        self.assertEqual(cleaned.loc[0, 'num_course_taken'], 3.0)
+        self.assertTrue(pd.isna(cleaned.loc[0, 'time_spent_hrs']))
+
     def test_intialize_output_db_exists(self):
         self.cursor.execute("""
                 CREATE TABLE students_analysis (
@@ -141,19 +217,40 @@ class TestClass(unittest.TestCase):
                     career_path_name text,
                     hours_to_complete integer)
                 """)
+        self.cursor.executemany("INSERT INTO students_analysis (uuid, name, job_id) VALUES (?, ?, ?)",
+                                [(1, 'old', '2.0'), (1, 'new', '3.0'), (2, 'Bob', None)])
         self.conn.commit()
 
         result_existing_table = intialize_output_db(self.conn, self.cursor, self.logger)
-        self.assertEqual(result_existing_table, [], "Expected empty list for existing table")
+        self.assertEqual(result_existing_table, SCHEMA_VERSION, "Existing table upgraded to the latest schema")
+        rows = self.cursor.execute("SELECT uuid, name, job_id, typeof(job_id), email FROM students_analysis")
+        self.assertEqual(rows.fetchall(), [(1, 'new', 3, 'integer', None), (2, 'Bob', None, 'null', None)])
+        self.assertEqual(apply_migrations(self.cursor), [], "Nothing left to migrate")
 
         with open(self.log_file, 'r') as log_file:
             log_contents = log_file.read()
-            self.assertIn("Table in output exists, gathering data", log_contents)
+            self.assertIn("Table in output exists, checking schema version", log_contents)
+            self.assertIn("Output DB migrated to schema version 1", log_contents)
 
     def test_intialize_output_db_not_exists(self):
 
         result_new_table = intialize_output_db(self.conn, self.cursor, self.logger)
-        self.assertEqual(result_new_table, [], "Expected empty list for new table")
+        self.assertEqual(result_new_table, SCHEMA_VERSION, "New table created at the latest schema")
+        self.assertEqual(self.cursor.execute("PRAGMA user_version").fetchone(), (SCHEMA_VERSION,))
+        uuid_pk = self.cursor.execute("SELECT pk FROM pragma_table_info('students_analysis') WHERE name = 'uuid'")
+        self.assertEqual(uuid_pk.fetchone(), (1,))
+        types = dict(self.cursor.execute("SELECT name, type FROM pragma_table_info('students_analysis')").fetchall())
+        self.assertEqual(types['job_id'], 'INTEGER')
+        self.assertEqual(types['time_spent_hrs'], 'REAL')
+        indexes = {row[0] for row in self.cursor.execute("SELECT name FROM pragma_index_list('students_analysis')")}
+        self.assertTrue({'students_analysis_career_path', 'students_analysis_job'} <= indexes)
+        plan = self.cursor.execute("EXPLAIN QUERY PLAN SELECT * FROM students_analysis WHERE job_id = 1").fetchall()
+        self.assertIn('students_analysis_job', str(plan))
+
+    def test_intialize_output_db_without_rowid(self):
+        intialize_output_db(self.conn, self.cursor, self.logger, without_rowid=True)
+        table_sql = self.cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'students_analysis'").fetchone()
+        self.assertIn('WITHOUT ROWID', table_sql[0])
 
         with open(self.log_file, 'r') as log_file:
             log_contents = log_file.read()
@@ -202,7 +299,13 @@ class TestCompareAndUpdateData(unittest.TestCase):
             'current_career_path_id': [5.0, 5.0],
             'time_spent_hrs': [5.99, 3.6],
             'career_path_name': ['data scientist', 'data analyst'],
-            'hours_to_complete': [20.0, 35.0]
+            'hours_to_complete': [20.0, 35.0],
+            'mailing_address': ['303 N Timber Key, Irondale, Wisconsin, 84736', '767 Crescent Fair, Shoals, Indiana, 37439'],
+            'email': ['annabelle_avery9376@woohoo.com', 'rubio6772@hmail.com'],
+            'street': ['303 N Timber Key', '767 Crescent Fair'],
+            'city': ['Irondale', 'Shoals'],
+            'state': ['Wisconsin', 'Indiana'],
+            'zip': ['84736', '37439']
         })
         self.wide_df['contact_info'] = self.wide_df['contact_info'].astype(str)
     def tearDown(self):
@@ -230,6 +333,46 @@ class TestCompareAndUpdateData(unittest.TestCase):
             log_contents = log_file.read()
             self.assertIn('Comparison dataframe completed', log_contents)
 
+        rows = self.cur.execute("SELECT uuid FROM students_analysis ORDER BY uuid").fetchall()
+        self.assertEqual(rows, [(1,), (2,)], "Updated and deleted uuids should not leave duplicates behind")
+
+    def test_compare_and_update_db_only_writes_changes(self):
+        first_df = compare_and_update_data(self.wide_df, self.cur, self.conn, self.logger)
+        self.assertEqual(len(first_df), 2)
+
+        second_df = compare_and_update_data(self.wide_df, self.cur, self.conn, self.logger)
+        self.assertEqual(len(second_df), 0, "Unchanged rows should not be written again")
+
+        changed_df = self.wide_df.copy()
+        changed_df.loc[1, 'time_spent_hrs'] = 9.5
+        third_df = compare_and_update_data(changed_df, self.cur, self.conn, self.logger)
+        self.assertEqual(third_df['uuid'].tolist(), [2])
+
+        rows = self.cur.execute("SELECT uuid, time_spent_hrs FROM students_analysis ORDER BY uuid").fetchall()
+        self.assertEqual(rows, [(1, 5.99), (2, 9.5)])
+
+    def test_compare_and_update_db_without_deletes(self):
+        compare_and_update_data(self.wide_df, self.cur, self.conn, self.logger)
+
+        result_df = compare_and_update_data(self.wide_df.iloc[:1], self.cur, self.conn, self.logger,
+                                            detect_deletes=False)
+        self.assertEqual(len(result_df), 0)
+        count = self.cur.execute("SELECT count(*) FROM students_analysis").fetchone()[0]
+        self.assertEqual(count, 2, "Rows missing from a partial extract must be kept")
+
+    def test_load_students_analysis_upserts_in_batches(self):
+        self.cur.executemany("INSERT INTO students_analysis (uuid, name) VALUES (?, ?)",
+                             [(1, 'Old Alice'), (1, 'Older Alice')])
+        self.conn.commit()
+
+        loaded = load_students_analysis(self.wide_df, self.conn, self.cur, self.logger, batch_size=1)
+        self.assertEqual(loaded, 2)
+
+        rows = self.cur.execute("SELECT uuid, name FROM students_analysis ORDER BY uuid").fetchall()
+        self.assertEqual(rows, [(1, 'Alice'), (2, 'Bob')])
+        with open(self.log_file, 'r') as log_file:
+            self.assertIn('rows/s, batch size 1', log_file.read())
+
     def test_compare_and_update_db_failure(self):
         with patch('sqlite3.connect') as mock_connect:
             mock_connect.return_value.cursor.return_value.execute.side_effect = Exception("Database query failed")
@@ -264,6 +407,622 @@ class TestCompareAndUpdateData(unittest.TestCase):
             self.assertEqual(written_content, expected_csv_content)
 
 
+class TestIncrementalExtraction(unittest.TestCase):
+    def setUp(self):
+        self.log_file = "test_log.log"
+        self.changelog_file = "test_changelog.log"
+        open(self.log_file, 'w').close()
+        open(self.changelog_file, 'w').close()
+        self.logger = setup_logger(self.log_file, self.changelog_file)
+        self.source = connect_to_database(':memory:', self.logger)
+        self.source_cur = self.source.cursor()
+        self.output = connect_to_database(':memory:', self.logger)
+        self.output_cur = self.output.cursor()
+
+        self.source_cur.execute("""
+            CREATE TABLE cademycode_students(
+                uuid INTEGER, name TEXT, dob TEXT, sex TEXT, contact_info TEXT, job_id TEXT,
+                num_course_taken TEXT, current_career_path_id TEXT, time_spent_hrs TEXT)""")
+        self.source_cur.execute("CREATE TABLE cademycode_student_jobs (job_id INTEGER, job_category TEXT, avg_salary INTEGER)")
+        self.source_cur.execute("CREATE TABLE cademycode_courses (career_path_id INTEGER, career_path_name TEXT, hours_to_complete INTEGER)")
+        self.source_cur.execute("INSERT INTO cademycode_student_jobs VALUES (1, 'analytics', 86000)")
+        self.source_cur.execute("INSERT INTO cademycode_courses VALUES (1, 'data scientist', 20)")
+        self.add_students([(1, 'Alice', '1990-01-01', 'F', '{}', '1.0', '2.0', '1.0', '4.5'),
+                           (2, 'Bob', '1991-02-02', 'M', '{}', None, '3.0', '1.0', '6.0')])
+        intialize_output_db(self.output, self.output_cur, self.logger)
+
+    def tearDown(self):
+        open(self.log_file, 'w').close()
+        open(self.changelog_file, 'w').close()
+        self.source.close()
+        self.output.close()
+
+    def add_students(self, rows):
+        self.source_cur.executemany("INSERT INTO cademycode_students VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.source.commit()
+
+    def run_once(self, full_refresh=False):
+        plan = plan_extraction(self.source_cur, self.output_cur, self.logger, full_refresh)
+        wide_df = extract_and_transform_data(self.source_cur, self.logger, plan)
+        compare_and_update_data(wide_df, self.output_cur, self.output, self.logger,
+                                detect_deletes=plan["full"], deleted_uuids=plan["deleted"])
+        save_watermarks(self.output, self.output_cur, plan, self.logger)
+        return plan, wide_df
+
+    def test_rowid_watermark_only_reads_new_rows(self):
+        plan, wide_df = self.run_once()
+        self.assertTrue(plan["full"])
+        self.assertEqual(len(wide_df), 2)
+
+        self.add_students([(3, 'Cara', '1992-03-03', 'F', '{}', '1.0', '1.0', '1.0', '1.0')])
+        plan, wide_df = self.run_once()
+        self.assertFalse(plan["full"])
+        self.assertEqual(wide_df['uuid'].tolist(), [3])
+
+        plan, wide_df = self.run_once(full_refresh=True)
+        self.assertTrue(plan["full"])
+        self.assertEqual(len(wide_df), 3)
+
+    def test_dimension_change_forces_full_extract(self):
+        self.run_once()
+        self.source_cur.execute("UPDATE cademycode_courses SET hours_to_complete = 25")
+        self.source.commit()
+
+        plan, wide_df = self.run_once()
+        self.assertTrue(plan["full"])
+        self.assertEqual(wide_df['hours_to_complete'].tolist(), [25.0, 25.0], "Cached course lookup was rebuilt")
+
+    def test_course_lookup_is_cached_and_left_joined(self):
+        self.add_students([(3, 'Cara', '1992-03-03', 'F', '{}', '1.0', '1.0', '7.0', '1.0'),
+                           (4, 'Dan', '1993-04-04', 'M', '{}', '1.0', '1.0', None, '1.0')])
+        courses = read_dimensions(self.source_cur)
+        self.assertIs(read_dimensions(self.source_cur), courses)
+
+        wide_df = build_wide_df(clean_students(pd.DataFrame(
+            self.source_cur.execute("SELECT * FROM cademycode_students").fetchall(),
+            columns=ANALYSIS_COLUMNS[:9])), courses)
+        self.assertEqual(wide_df['uuid'].tolist(), [1, 2, 3, 4])
+        self.assertEqual(wide_df['career_path_name'].tolist()[:2], ['data scientist', 'data scientist'])
+        self.assertTrue(wide_df.loc[2:, ['career_path_name', 'hours_to_complete']].isna().all().all())
+
+    def test_change_tracking_picks_up_updates_and_deletes(self):
+        install_change_tracking(self.source, self.source_cur, self.logger)
+        self.run_once()
+
+        self.source_cur.execute("UPDATE cademycode_students SET time_spent_hrs = '9.0' WHERE uuid = 1")
+        self.source_cur.execute("DELETE FROM cademycode_students WHERE uuid = 2")
+        self.source.commit()
+
+        plan, wide_df = self.run_once()
+        self.assertEqual(plan["mode"], "changes")
+        self.assertEqual(wide_df['uuid'].tolist(), [1])
+        rows = self.output_cur.execute("SELECT uuid, time_spent_hrs FROM students_analysis").fetchall()
+        self.assertEqual(rows, [(1, 9.0)])
+
+
+class TestStreamingPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.source_db = os.path.join(self.tmp_dir.name, "source.db")
+        self.output_db = os.path.join(self.tmp_dir.name, "output.db")
+        self.csv_file = os.path.join(self.tmp_dir.name, "output.csv")
+        self.log_file = os.path.join(self.tmp_dir.name, "log.txt")
+        self.changelog_file = os.path.join(self.tmp_dir.name, "changelog.txt")
+
+        con = sqlite3.connect(self.source_db)
+        con.execute("""CREATE TABLE cademycode_students(
+                           uuid INTEGER, name TEXT, dob TEXT, sex TEXT, contact_info TEXT, job_id TEXT,
+                           num_course_taken TEXT, current_career_path_id TEXT, time_spent_hrs TEXT)""")
+        con.execute("CREATE TABLE cademycode_student_jobs (job_id INTEGER, job_category TEXT, avg_salary INTEGER)")
+        con.execute("CREATE TABLE cademycode_courses (career_path_id INTEGER, career_path_name TEXT, hours_to_complete INTEGER)")
+        con.execute("INSERT INTO cademycode_courses VALUES (1, 'data scientist', 20)")
+        con.executemany("INSERT INTO cademycode_students VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(uuid, f'Student {uuid}', '1990-01-01', 'F', '{}', '1.0', '2.0', '1.0', '4.5')
+                         for uuid in range(1, 6)])
+        con.commit()
+        con.close()
+
+    def tearDown(self):
+        close_logger(logging.getLogger("Subscriber_Pipeline_Functions"))
+        self.tmp_dir.cleanup()
+
+    def run_pipeline(self, **kwargs):
+        pipeline(self.source_db, self.csv_file, self.output_db, self.log_file, self.changelog_file, **kwargs)
+        con = sqlite3.connect(self.output_db)
+        uuids = [row[0] for row in con.execute("SELECT uuid FROM students_analysis ORDER BY uuid")]
+        con.close()
+        return uuids
+
+    def test_pipeline_writes_run_metrics(self):
+        metrics_file = os.path.join(self.tmp_dir.name, "subscriber_metrics.jsonl")
+        prometheus_file = os.path.join(self.tmp_dir.name, "subscriber_pipeline.prom")
+        self.run_pipeline(chunk_size=2)
+
+        with open(metrics_file) as file:
+            run = json.loads(file.readlines()[-1])
+        self.assertEqual(run["status"], "success")
+        self.assertEqual(run["counters"]["rows_read"], 5)
+        self.assertEqual(run["counters"]["rows_inserted"], 5)
+        self.assertGreater(run["counters"]["bytes_written"], 0)
+        for stage in ["extract_and_transform_chunks", "diff_data", "load_students_analysis", "export"]:
+            self.assertIn(stage, run["stages"])
+        if os.path.exists("/proc/self/statm"):
+            self.assertEqual(set(run["stage_rss_delta_mb"]), set(run["stages"]))
+
+        with open(prometheus_file) as file:
+            prometheus = file.read()
+        self.assertIn('subscriber_pipeline_rows{kind="inserted"} 5', prometheus)
+        self.assertIn('subscriber_pipeline_last_run_success 1', prometheus)
+
+    def test_chunks_cover_every_student(self):
+        con = sqlite3.connect(self.source_db)
+        logger = setup_logger(self.log_file, self.changelog_file)
+        chunks = list(extract_and_transform_chunks(con.cursor(), logger, chunksize=2))
+        con.close()
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+
+    def test_streaming_pipeline_loads_and_removes(self):
+        self.assertEqual(self.run_pipeline(chunk_size=2), [1, 2, 3, 4, 5])
+        self.assertEqual(len(pd.read_csv(self.csv_file)), 5)
+
+        con = sqlite3.connect(self.source_db)
+        con.execute("DELETE FROM cademycode_students WHERE uuid = 3")
+        con.commit()
+        con.close()
+
+        self.assertEqual(self.run_pipeline(chunk_size=2, full_refresh=True), [1, 2, 4, 5])
+        self.assertEqual(len(pd.read_csv(self.csv_file)), 0)
+
+    def test_pipeline_logs_changes_and_runs(self):
+        self.run_pipeline()
+        con = sqlite3.connect(self.source_db)
+        con.execute("UPDATE cademycode_students SET name = 'Renamed', time_spent_hrs = '8.0' WHERE uuid = 2")
+        con.execute("DELETE FROM cademycode_students WHERE uuid = 5")
+        con.commit()
+        con.close()
+        self.run_pipeline(full_refresh=True)
+
+        con = sqlite3.connect(self.output_db)
+        runs = con.execute("""SELECT run_id, status, rows_inserted, rows_updated, rows_deleted
+                              FROM pipeline_runs ORDER BY run_id""").fetchall()
+        self.assertEqual([run[1:] for run in runs], [('success', 5, 0, 0), ('success', 0, 1, 1)])
+        changes = con.execute("""SELECT uuid, operation, changed_columns FROM students_analysis_changes
+                                 WHERE run_id > ? ORDER BY uuid""", (runs[0][0],)).fetchall()
+        con.close()
+        self.assertEqual(changes, [(2, 'U', '["name", "time_spent_hrs"]'), (5, 'D', None)])
+
+    def test_connection_profiles(self):
+        source = open_connection(self.source_db, "snapshot")
+        with self.assertRaises(sqlite3.OperationalError):
+            source.execute("DELETE FROM cademycode_students")
+        self.assertEqual(source.execute("SELECT count(*) FROM cademycode_students").fetchone(), (5,))
+        source.close()
+
+        output = open_connection(self.output_db, "output")
+        self.assertEqual(output.execute("PRAGMA journal_mode").fetchone(), ('wal',))
+        attach_database(output.cursor(), self.source_db, "source")
+        self.assertEqual(output.execute("SELECT count(*) FROM source.cademycode_students").fetchone(), (5,))
+        output.close()
+
+    def test_sql_diff_matches_hash_diff(self):
+        self.assertEqual(self.run_pipeline(diff_mode="sql"), [1, 2, 3, 4, 5])
+        con = sqlite3.connect(self.source_db)
+        con.execute("UPDATE cademycode_students SET name = 'Renamed' WHERE uuid = 2")
+        con.execute("DELETE FROM cademycode_students WHERE uuid = 5")
+        con.commit()
+        con.close()
+
+        self.assertEqual(self.run_pipeline(diff_mode="sql", chunk_size=2, full_refresh=True), [1, 2, 3, 4])
+        self.assertEqual(pd.read_csv(self.csv_file)['name'].tolist(), ['Renamed'])
+        con = sqlite3.connect(self.output_db)
+        changes = con.execute("""SELECT uuid, operation, changed_columns FROM students_analysis_changes
+                                 WHERE operation != 'I' ORDER BY uuid""").fetchall()
+        con.close()
+        self.assertEqual(changes, [(2, 'U', '["name"]'), (5, 'D', None)])
+
+        # The SQL diff stores the same row hashes, so switching back to hash mode finds nothing to rewrite
+        self.run_pipeline(full_refresh=True)
+        self.assertEqual(len(pd.read_csv(self.csv_file)), 0)
+
+    def test_sql_diff_exports_changes_in_chunks(self):
+        import Pipeline_writers
+
+        with patch("Pipeline_main.pw.write_output", wraps=Pipeline_writers.write_output) as write_output:
+            self.assertEqual(self.run_pipeline(diff_mode="sql", chunk_size=2), [1, 2, 3, 4, 5])
+
+        self.assertEqual([len(call.args[1]) for call in write_output.call_args_list], [2, 2, 1])
+        self.assertEqual(pd.read_csv(self.csv_file)['uuid'].tolist(), [1, 2, 3, 4, 5])
+        # Every chunk got its hashes, so a hash-mode rerun finds nothing to rewrite
+        self.run_pipeline(full_refresh=True)
+        self.assertEqual(len(pd.read_csv(self.csv_file)), 0)
+
+    def test_attached_detaches_only_what_it_attached(self):
+        output = open_connection(self.output_db, "output")
+        with attached(output, self.source_db, "source") as outer:
+            with attached(output, self.source_db, "source") as inner:
+                pass
+            self.assertEqual((outer, inner), (True, False))
+            self.assertEqual(output.execute("SELECT count(*) FROM source.cademycode_students").fetchone(), (5,))
+
+        with self.assertRaises(ZeroDivisionError):
+            with attached(output, self.source_db, "source"):
+                output.execute("BEGIN")
+                output.execute("CREATE TABLE scratch (id INTEGER)")
+                1 / 0
+        self.assertFalse(output.in_transaction, "A transaction left open by the error is rolled back")
+        self.assertEqual([row[1] for row in output.execute("PRAGMA database_list")], ["main"])
+        output.close()
+
+    def test_sharded_pipeline_matches_single_process(self):
+        self.assertEqual(self.run_pipeline(workers=2, shard_size=2), [1, 2, 3, 4, 5])
+        self.assertEqual(sorted(pd.read_csv(self.csv_file)['uuid']), [1, 2, 3, 4, 5])
+
+        con = sqlite3.connect(self.source_db)
+        con.execute("UPDATE cademycode_students SET time_spent_hrs = '8.0' WHERE uuid = 4")
+        con.execute("DELETE FROM cademycode_students WHERE uuid = 3")
+        con.commit()
+        con.close()
+
+        self.assertEqual(self.run_pipeline(workers=2, shard_size=2, full_refresh=True), [1, 2, 4, 5])
+        self.assertEqual(pd.read_csv(self.csv_file)['uuid'].tolist(), [4])
+
+    def test_sql_transform_with_sql_diff(self):
+        self.assertEqual(self.run_pipeline(diff_mode="sql", transform="sql"), [1, 2, 3, 4, 5])
+        con = sqlite3.connect(self.source_db)
+        con.execute("UPDATE cademycode_students SET job_id = NULL WHERE uuid = 3")
+        con.commit()
+        con.close()
+
+        self.assertEqual(self.run_pipeline(diff_mode="sql", transform="sql", full_refresh=True), [1, 2, 3, 4, 5])
+        self.assertEqual(pd.read_csv(self.csv_file)[['uuid', 'job_id']].values.tolist(), [[3, 99]])
+        # Rows staged straight from the source still get the hashes the pandas transform would give them
+        self.run_pipeline(full_refresh=True)
+        self.assertEqual(len(pd.read_csv(self.csv_file)), 0)
+
+    def run_state(self):
+        con = sqlite3.connect(self.output_db)
+        state = {"runs": con.execute("SELECT run_id, status, rows_inserted FROM pipeline_runs").fetchall(),
+                 "checkpoints": con.execute("SELECT run_id, stage FROM pipeline_checkpoints").fetchall(),
+                 "changes": con.execute("""SELECT run_id, count(*) FROM students_analysis_changes
+                                           GROUP BY run_id""").fetchall(),
+                 "pending": con.execute("SELECT count(*) FROM students_pending").fetchone()[0]}
+        con.close()
+        return state
+
+    def test_failed_chunk_leaves_output_untouched(self):
+        calls = []
+
+        def fail_second_chunk(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise ValueError("bad chunk")
+            return build_wide_df(*args)
+
+        with patch("Subscriber_Pipeline_Functions.build_wide_df", side_effect=fail_second_chunk):
+            self.assertEqual(self.run_pipeline(chunk_size=2), [])
+        # The first chunk was diffed and exported, but none of it was committed or left on disk
+        self.assertFalse(os.path.exists(self.csv_file))
+        self.assertFalse([name for name in os.listdir(self.tmp_dir.name) if name.endswith(".tmp")])
+        state = self.run_state()
+        self.assertEqual((state["runs"][0][1], state["checkpoints"], state["pending"]), ("failed", [], 0))
+
+        self.assertEqual(self.run_pipeline(chunk_size=2), [1, 2, 3, 4, 5])
+        self.assertEqual(len(pd.read_csv(self.csv_file)), 5)
+
+    def test_failed_load_resumes_without_extracting(self):
+        with patch("Subscriber_Pipeline_Functions.apply_pending", side_effect=sqlite3.OperationalError("disk I/O")):
+            self.assertEqual(self.run_pipeline(chunk_size=2), [])
+        self.assertFalse(os.path.exists(self.csv_file))
+        state = self.run_state()
+        run_id = state["runs"][0][0]
+        self.assertEqual((state["checkpoints"], state["pending"]), ([(run_id, "diffed")], 5))
+
+        with patch("Subscriber_Pipeline_Functions.plan_extraction", wraps=plan_extraction) as plan, \
+                patch("Subscriber_Pipeline_Functions.extract_and_transform_chunks",
+                      wraps=extract_and_transform_chunks) as extract:
+            self.assertEqual(self.run_pipeline(chunk_size=2), [1, 2, 3, 4, 5])
+        # Only the normal run that follows the resume plans and extracts, and it finds nothing new
+        self.assertEqual((plan.call_count, extract.call_count), (1, 1))
+        self.assertEqual(len(pd.read_csv(self.csv_file)), 0)
+        # The resumed run completes the failed run's record, checkpoint and change log
+        state = self.run_state()
+        self.assertEqual(state["runs"][0], (run_id, "success", 5))
+        self.assertEqual([status for _, status, _ in state["runs"]], ["success", "success"])
+        self.assertIn((run_id, "published"), state["checkpoints"])
+        self.assertEqual((state["changes"], state["pending"]), ([(run_id, 5)], 0))
+
+    def test_failed_publish_resumes_with_the_staged_export(self):
+        with patch("Pipeline_writers.os.replace", side_effect=OSError("read-only file system")):
+            self.assertEqual(self.run_pipeline(), [1, 2, 3, 4, 5])
+        self.assertFalse(os.path.exists(self.csv_file))
+        self.assertEqual(self.run_state()["checkpoints"][0][1], "loaded")
+
+        # Added after the failed run: the resume only finishes the failed batch, the run after it picks this up
+        con = sqlite3.connect(self.source_db)
+        con.execute("""INSERT INTO cademycode_students
+                       VALUES (6, 'Student 6', '1990-01-01', 'F', '{}', '1.0', '2.0', '1.0', '4.5')""")
+        con.commit()
+        con.close()
+        publish_dir = os.path.join(self.tmp_dir.name, "prod")
+        os.makedirs(publish_dir)
+        self.assertEqual(self.run_pipeline(publish_dir=publish_dir), [1, 2, 3, 4, 5, 6])
+
+        first, second = [os.path.join(publish_dir, name, "output.csv") for name in sorted(os.listdir(publish_dir))]
+        self.assertEqual(pd.read_csv(first)['uuid'].tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(pd.read_csv(second)['uuid'].tolist(), [6])
+        self.assertFalse(os.path.exists(self.csv_file))
+        state = self.run_state()
+        self.assertEqual([(status, rows) for _, status, rows in state["runs"]], [("success", 5), ("success", 1)])
+        self.assertEqual(([stage for _, stage in state["checkpoints"]], [count for _, count in state["changes"]]),
+                         (["published", "published"], [5, 1]))
+
+    def test_debug_log_samples_the_loaded_rows(self):
+        debug_file = os.path.join(self.tmp_dir.name, "rows.log")
+        for options in [{}, {"chunk_size": 2}, {"workers": 2, "shard_size": 2}, {"diff_mode": "sql", "chunk_size": 2}]:
+            with self.subTest(**options):
+                for path in [self.output_db, debug_file]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                self.assertEqual(self.run_pipeline(debug_log=debug_file, debug_sample_rate=1.0, **options),
+                                 [1, 2, 3, 4, 5])
+                close_logger(logging.getLogger("Subscriber_Pipeline_Functions"))
+                with open(debug_file, 'r') as rows_file:
+                    self.assertEqual(rows_file.read().count("loaded uuid="), 5)
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), deadline, "timed out waiting for the daemon")
+            time.sleep(0.02)
+
+    def test_daemon_runs_only_when_source_changes(self):
+        publish_dir = os.path.join(self.tmp_dir.name, "prod")
+        os.makedirs(publish_dir)
+        published = lambda: sorted(name for name in os.listdir(publish_dir) if not name.startswith("."))
+        stop = threading.Event()
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+            daemon(self.source_db, self.csv_file, self.output_db, self.log_file, self.changelog_file, interval=0.02,
+                   publish_dir=publish_dir, stop=stop)))
+        thread.start()
+        try:
+            self.wait_for(lambda: len(published()) == 1)
+            # Unchanged source: the daemon keeps polling without starting another cycle
+            time.sleep(0.2)
+            self.assertEqual(len(published()), 1)
+
+            con = sqlite3.connect(self.source_db)
+            con.execute("""INSERT INTO cademycode_students
+                           VALUES (6, 'Student 6', '1990-01-01', 'F', '{}', '1.0', '2.0', '1.0', '4.5')""")
+            con.commit()
+            con.close()
+            self.wait_for(lambda: len(published()) == 2)
+        finally:
+            stop.set()
+            thread.join(10)
+
+        self.assertEqual(result, [2])
+        first, second = [os.path.join(publish_dir, name, "output.csv") for name in published()]
+        self.assertEqual(pd.read_csv(first)['uuid'].tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(pd.read_csv(second)['uuid'].tolist(), [6])
+        con = sqlite3.connect(self.output_db)
+        self.assertEqual(con.execute("SELECT count(*), min(status) FROM pipeline_runs").fetchone(), (2, 'success'))
+        con.close()
+
+
+class TestSqlTransform(unittest.TestCase):
+    def setUp(self):
+        self.logger = MagicMock()
+
+    def assert_transforms_match(self, cur):
+        pandas_df = extract_and_transform_data(cur, self.logger)
+        sql_df = extract_and_transform_data(cur, self.logger, transform="sql")
+        pd.testing.assert_frame_equal(sql_df, pandas_df)
+        self.assertTrue((hash_rows(sql_df) == hash_rows(pandas_df)).all())
+
+    def test_sql_transform_matches_pandas_on_source_dbs(self):
+        for name in ["cademycode.db", "cademycode_updated.db"]:
+            with self.subTest(db=name):
+                con = sqlite3.connect(os.path.join(os.path.dirname(os.path.abspath(__file__)), name))
+                self.assert_transforms_match(con.cursor())
+                con.close()
+
+    def test_sql_transform_matches_pandas_on_malformed_rows(self):
+        con = sqlite3.connect(":memory:")
+        con.execute("""CREATE TABLE cademycode_students(
+                           uuid INTEGER, name TEXT, dob TEXT, sex TEXT, contact_info TEXT, job_id TEXT,
+                           num_course_taken TEXT, current_career_path_id TEXT, time_spent_hrs TEXT)""")
+        con.execute("CREATE TABLE cademycode_courses (career_path_id INTEGER, career_path_name TEXT, hours_to_complete INTEGER)")
+        con.executemany("INSERT INTO cademycode_courses VALUES (?, ?, ?)",
+                        [(1, 'data scientist', 20), (2, 'data engineer', 20), (2, 'duplicate', 99)])
+        con.executemany("INSERT INTO cademycode_students VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+            (1, 'a', '1990-01-01', 'F', 'not json', 'n/a', ' 3 ', 'abc', '1e1'),
+            (2, 'b', '1990-01-01', 'M', '[1, 2]', None, '', '2.0', None),
+            (3, 'c', '1990-01-01', 'M', '{"mailing_address": "1 A St, Apt 2, Town, State, 12345", "email": "c@example.com"}',
+             '3', '2', '2', '1'),
+            (4, 'd', '1990-01-01', 'M', '{"mailing_address": "Town, State"}', '3', '2', '7', '1'),
+            (5, 'e', '1990-01-01', 'F', '{"mailing_address": ""}', '3', '2', '1', '1'),
+            (6, 'f', '1990-01-01', 'F', None, '3', '2', '1', '1')])
+        self.assert_transforms_match(con.cursor())
+        con.close()
+
+
+class TestCompactDtypes(unittest.TestCase):
+    def wide_df(self, name):
+        con = sqlite3.connect(os.path.join(os.path.dirname(os.path.abspath(__file__)), name))
+        cur = con.cursor()
+        students_df = pd.DataFrame(cur.execute("SELECT * FROM cademycode_students").fetchall(),
+                                   columns=["uuid", "name", "dob", "sex", "contact_info", "job_id", "num_course_taken",
+                                            "current_career_path_id", "time_spent_hrs"])
+        wide_df = build_wide_df(clean_students(students_df), read_dimensions(cur))
+        con.close()
+        return wide_df
+
+    def test_compact_dtypes_keep_hashes_and_records(self):
+        for name in ["cademycode.db", "cademycode_updated.db"]:
+            with self.subTest(db=name):
+                wide_df = self.wide_df(name)
+                logger = MagicMock()
+                compact = compact_dtypes(wide_df, logger)
+
+                for column in ["sex", "career_path_name", "job_id"]:
+                    self.assertIsInstance(compact[column].dtype, pd.CategoricalDtype)
+                self.assertTrue(pd.api.types.is_datetime64_any_dtype(compact["dob"]))
+                self.assertLess(compact.memory_usage(deep=True).sum(), wide_df.memory_usage(deep=True).sum())
+                self.assertIn("Compact dtypes", logger.info.call_args[0][0])
+
+                self.assertTrue((hash_rows(compact) == hash_rows(wide_df)).all())
+                self.assertEqual(to_records(compact), to_records(wide_df))
+                pd.testing.assert_frame_equal(plain_dtypes(compact), wide_df)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow not installed")
+    def test_text_columns_are_pyarrow_backed(self):
+        wide_df = self.wide_df("cademycode.db")
+        compact = compact_dtypes(wide_df)
+        for column in ["name", "contact_info", "email", "zip"]:
+            self.assertEqual(compact[column].dtype.storage, "pyarrow")
+        self.assertEqual(plain_dtypes(compact)["name"].dtype, wide_df["name"].dtype)
+
+    def test_lossy_values_keep_their_dtype(self):
+        wide_df = self.wide_df("cademycode.db").head(3).copy()
+        wide_df["time_spent_hrs"] = pd.array([0.1, 1.5, None], dtype="Float64")
+        wide_df["dob"] = ["1990-01-01", "01/02/1990", None]
+        compact = compact_dtypes(wide_df)
+
+        self.assertEqual(str(compact["time_spent_hrs"].dtype), "Float64")
+        self.assertFalse(pd.api.types.is_datetime64_any_dtype(compact["dob"]))
+        self.assertTrue((hash_rows(compact) == hash_rows(wide_df)).all())
+
+
+class TestOutputWriters(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.output_file = os.path.join(self.tmp_dir.name, "subscriber_pipeline.csv")
+        self.logger = MagicMock()
+        self.data = pd.DataFrame({'uuid': [1, 2, 3], 'name': ['Alice', 'Bob', 'Cara'],
+                                  'job_id': pd.array([5, 7, None], dtype='Int64'),
+                                  'time_spent_hrs': [5.99, 3.6, None],
+                                  'career_path_name': ['data scientist', 'ux/ui designer', None]})
+        self.data = self.data.reindex(columns=ANALYSIS_COLUMNS)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_chunks(self, output_format):
+        writer = open_writer(output_format, self.output_file, self.logger)
+        self.assertTrue(write_output(writer, self.data.iloc[:2], self.logger))
+        self.assertTrue(write_output(writer, self.data.iloc[2:], self.logger))
+        self.assertTrue(close_writer(writer, self.logger))
+        self.logger.info.assert_called_with("Data exported, 3 rows submitted.")
+        # Nothing appears under the final name until the finished file is moved into place
+        self.assertFalse(os.path.exists(output_path(self.output_file, output_format)))
+        self.assertEqual(replace_output(self.output_file, output_format, self.logger),
+                         output_path(self.output_file, output_format))
+        self.assertFalse(os.path.exists(writer.path))
+
+    def test_csv_writers(self):
+        for output_format, suffix in [('csv', '.csv'), ('csv.gz', '.csv.gz')]:
+            self.write_chunks(output_format)
+            written = pd.read_csv(os.path.join(self.tmp_dir.name, 'subscriber_pipeline' + suffix))
+            self.assertEqual(written['uuid'].tolist(), [1, 2, 3])
+            self.assertEqual(list(written.columns), ANALYSIS_COLUMNS)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow not installed")
+    def test_arrow_writer(self):
+        import pyarrow as pa
+
+        self.write_chunks('arrow')
+        with pa.OSFile(os.path.join(self.tmp_dir.name, 'subscriber_pipeline.arrow')) as source:
+            table = pa.ipc.open_file(source).read_all()
+        self.assertEqual(table.column('uuid').to_pylist(), [1, 2, 3])
+        self.assertEqual(table.column('job_id').to_pylist(), [5, 7, None])
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow not installed")
+    def test_parquet_writer_partitions(self):
+        import pyarrow.dataset as ds
+
+        self.write_chunks('parquet')
+        dataset = ds.dataset(os.path.join(self.tmp_dir.name, 'subscriber_pipeline'), partitioning='hive')
+        table = dataset.to_table().sort_by('uuid')
+        self.assertEqual(table.column('uuid').to_pylist(), [1, 2, 3])
+        self.assertEqual(table.column('career_path_name').to_pylist(), ['data scientist', 'ux/ui designer', None])
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow not installed")
+    def test_parquet_runs_on_the_same_day_add_up(self):
+        import pyarrow.dataset as ds
+
+        for run_id, data in [('1', self.data), ('2', self.data.iloc[:1].assign(name='Alicia'))]:
+            writer = open_writer('parquet', self.output_file, self.logger, run_id)
+            self.assertTrue(write_output(writer, data, self.logger))
+            self.assertTrue(close_writer(writer, self.logger))
+            self.assertIsNotNone(replace_output(self.output_file, 'parquet', self.logger))
+
+        dataset = ds.dataset(os.path.join(self.tmp_dir.name, 'subscriber_pipeline'), partitioning='hive')
+        table = dataset.to_table().sort_by([('uuid', 'ascending'), ('name', 'ascending')])
+        self.assertEqual(table.column('uuid').to_pylist(), [1, 1, 2, 3])
+        self.assertEqual(table.column('name').to_pylist(), ['Alice', 'Alicia', 'Bob', 'Cara'])
+        self.assertEqual(sorted(os.path.basename(path) for path in dataset.files),
+                         ['part-1.parquet', 'part-1.parquet', 'part-1.parquet', 'part-2.parquet'])
+
+
+@unittest.skipUnless(os.path.exists("/proc/self/statm"), "current RSS is read from /proc")
+class TestPipelineMetrics(unittest.TestCase):
+    def test_stage_memory_is_the_change_within_the_stage(self):
+        import numpy as np
+
+        metrics = PipelineMetrics()
+        with metrics.stage("allocate"):
+            data = np.ones(10_000_000)
+        with metrics.stage("after"):
+            data.sum()
+        del data
+
+        deltas = metrics.as_dict()["stage_rss_delta_mb"]
+        self.assertGreater(deltas["allocate"], 60)
+        self.assertLess(deltas["after"], 10, "A later stage does not inherit the earlier stage's memory")
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.template_db = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cademycode.db")
+        self.source_db = os.path.join(self.tmp_dir.name, "cademycode_500.db")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_generate_database_follows_template(self):
+        profile = profile_source(self.template_db)
+        generate_database(self.source_db, 500, profile, self.template_db, chunk_size=200)
+
+        con = sqlite3.connect(self.source_db)
+        count, uuids = con.execute("SELECT count(*), count(DISTINCT uuid) FROM cademycode_students").fetchone()
+        courses = con.execute("SELECT count(*) FROM cademycode_courses").fetchone()[0]
+        contact = con.execute("SELECT contact_info FROM cademycode_students LIMIT 1").fetchone()[0]
+        con.close()
+
+        self.assertEqual((count, uuids), (500, 500))
+        self.assertEqual(courses, 10)
+        self.assertIn("mailing_address", contact)
+        self.assertEqual(set(profile["sex"]), {"F", "M", "N"})
+
+    def test_run_once_measures_the_pipeline(self):
+        generate_database(self.source_db, 300, profile_source(self.template_db), self.template_db)
+        output_db = os.path.join(self.tmp_dir.name, "output.db")
+        output_file = os.path.join(self.tmp_dir.name, "subscriber_pipeline.csv")
+
+        first = run_once(self.source_db, output_db, output_file, chunk_size=100)
+        self.assertEqual(len(pd.read_csv(output_file)), 300, "The export is published under its final name")
+        second = run_once(self.source_db, output_db, output_file, workers=2, shard_size=100)
+        third = run_once(self.source_db, output_db, output_file, diff_mode="sql")
+
+        self.assertTrue({"extract_and_transform_chunks", "load_students_analysis", "export", "publish"}
+                        <= set(first["stages"]))
+        self.assertEqual((first["rows_read"], first["rows_changed"]), (300, 300))
+        self.assertEqual((second["rows_read"], second["rows_changed"]), (300, 0))
+        self.assertEqual((third["rows_read"], third["rows_changed"]), (300, 0))
+        self.assertEqual([name for name in os.listdir(self.tmp_dir.name) if name.endswith(".tmp")], [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,19 +1,96 @@
+import atexit
+import hashlib
+import json
 import logging
+import os
+import queue
 import sys
 import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from urllib.request import pathname2url
+
+import numpy as np
 import pandas as pd
 
+import Pipeline_metrics as pm
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import pyarrow
+    ARROW_STRING = pd.StringDtype("pyarrow")
+except ImportError:
+    ARROW_STRING = None
+
+ADDRESS_COLUMNS = ["street", "city", "state", "zip"]
+CONTACT_COLUMNS = ["mailing_address", "email"] + ADDRESS_COLUMNS
+ANALYSIS_COLUMNS = ["uuid", "name", "dob", "sex", "contact_info", "job_id", "num_course_taken",
+                    "current_career_path_id", "time_spent_hrs", "career_path_name", "hours_to_complete"] + CONTACT_COLUMNS
+STUDENT_COLUMNS = ['uuid', 'name', 'dob', 'sex', 'contact_info', 'job_id', 'num_course_taken',
+                   'current_career_path_id', 'time_spent_hrs']
+NUMERIC_COLUMNS = ["job_id", "num_course_taken", "current_career_path_id", "time_spent_hrs", "hours_to_complete"]
+DIMENSION_TABLES = ["cademycode_student_jobs", "cademycode_courses"]
+ANALYSIS_TYPES = {"uuid": "INTEGER PRIMARY KEY", "name": "TEXT", "dob": "TEXT", "sex": "TEXT", "contact_info": "TEXT",
+                  "job_id": "INTEGER", "num_course_taken": "REAL", "current_career_path_id": "INTEGER",
+                  "time_spent_hrs": "REAL", "career_path_name": "TEXT", "hours_to_complete": "REAL",
+                  "mailing_address": "TEXT", "email": "TEXT", "street": "TEXT", "city": "TEXT", "state": "TEXT",
+                  "zip": "TEXT"}
+LOAD_BATCH_SIZE = 5000
+SHARD_SIZE = 100000
+CATEGORY_COLUMNS = ["sex", "career_path_name", "job_id"]
+TEXT_COLUMNS = ["name", "dob", "contact_info"] + CONTACT_COLUMNS
+FLOAT32_TYPES = {"Float64": "Float32", "float64": "float32"}
+
+
+class BufferedFileHandler(logging.FileHandler):
+    # Leaves flushing to the queue listener, which flushes once the queue is drained instead of on every record
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class DrainingQueueListener(QueueListener):
+    def handle(self, record):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+
+# Logger name -> (settings, handlers attached to the logger, handlers writing the output, queue listener or None)
+LOGGERS = {}
+ROW_SAMPLE_RATES = {}
+
+def setup_logger(log_file, changelog_file, logger_name=__name__, background=False, debug_file=None,
+                 debug_sample_rate=0.01):
+    logger = logging.getLogger(logger_name)
+    settings = (os.path.abspath(log_file), os.path.abspath(changelog_file), background,
+                debug_file and os.path.abspath(debug_file), debug_sample_rate)
+    existing = LOGGERS.get(logger_name)
+    # Calling again with the same files reuses the handlers instead of stacking another set
+    if existing and existing[0] == settings and all(handler in logger.handlers for handler in existing[1]):
+        return logger
+    close_logger(logger)
 
-def setup_logger(log_file, changelog_file):
-    logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter(fmt="%(asctime)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    file_handler_class = BufferedFileHandler if background else logging.FileHandler
 
-    file_handler = logging.FileHandler(log_file, encoding="utf-8")
+    file_handler = file_handler_class(log_file, encoding="utf-8")
     file_handler.setLevel(logging.INFO)
     file_handler.setFormatter(formatter)
     
-    change_handler = logging.FileHandler(changelog_file, encoding="utf-8")
+    change_handler = file_handler_class(changelog_file, encoding="utf-8")
     change_handler.setLevel(logging.WARNING)
     change_handler.setFormatter(formatter)
 
@@ -21,38 +98,485 @@ def setup_logger(log_file, changelog_file):
     stream_handler.setLevel(logging.INFO)
     stream_handler.setFormatter(formatter)
 
-    logger.addHandler(file_handler)
-    logger.addHandler(change_handler)
-    logger.addHandler(stream_handler)
+    handlers = [file_handler, change_handler, stream_handler]
+    rows_logger = logging.getLogger(f"{logger_name}.rows")
+    if debug_file:
+        # Sampled per-row records from log_row_sample, kept out of the other outputs by level
+        debug_handler = file_handler_class(debug_file, encoding="utf-8")
+        debug_handler.setLevel(logging.DEBUG)
+        debug_handler.addFilter(logging.Filter(rows_logger.name))
+        debug_handler.setFormatter(formatter)
+        handlers.append(debug_handler)
+        rows_logger.setLevel(logging.DEBUG)
+        ROW_SAMPLE_RATES[rows_logger.name] = debug_sample_rate
+    else:
+        rows_logger.setLevel(logging.INFO)
+
+    listener = None
+    attached = handlers
+    if background:
+        # Log calls only enqueue the record, a listener thread does the formatting and file/terminal writes
+        log_queue = queue.Queue()
+        listener = DrainingQueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        attached = [QueueHandler(log_queue)]
+
+    for handler in attached:
+        logger.addHandler(handler)
+    LOGGERS[logger_name] = (settings, attached, handlers, listener)
     return logger
 
-def connect_to_database(db_path, logger):
+def flush_logger(logger):
+    existing = LOGGERS.get(logger.name)
+    if existing is None:
+        return
+    if existing[3] is not None:
+        existing[3].queue.join()
+    for handler in existing[2]:
+        handler.flush()
+
+def close_logger(logger):
+    existing = LOGGERS.pop(logger.name, None)
+    if existing is None:
+        return
+    _, attached, handlers, listener = existing
+    for handler in attached:
+        logger.removeHandler(handler)
+    if listener is not None:
+        listener.stop()
+    for handler in handlers:
+        handler.close()
+
+@atexit.register
+def close_loggers():
+    for name in list(LOGGERS):
+        close_logger(logging.getLogger(name))
+
+def log_row_sample(logger, df, stage):
+    rows_logger = logging.getLogger(f"{logger.name}.rows")
+    if df.empty or not rows_logger.isEnabledFor(logging.DEBUG):
+        return
+    # One vectorised draw per frame, so a low rate costs next to nothing on large chunks
+    sample = df[np.random.random(len(df)) < ROW_SAMPLE_RATES.get(rows_logger.name, 0.0)]
+    for row in sample.to_dict("records"):
+        rows_logger.debug(f"{stage} uuid={row['uuid']}: {row}")
+
+MMAP_SIZE = 256 * 1024 * 1024
+READ_PRAGMAS = ["PRAGMA query_only=ON", f"PRAGMA mmap_size={MMAP_SIZE}", "PRAGMA cache_size=-65536",
+                "PRAGMA temp_store=MEMORY"]
+# reader: read-only and memory-mapped, for the source DB, the daemon's source watcher and the workers' view of the
+# output DB; snapshot: the same but immutable=1, so sqlite also skips locking and change detection (only for source
+# files nothing writes to during the run); output: WAL with synchronous=NORMAL for the single writer
+CONNECTION_PROFILES = {
+    "reader": ("mode=ro", READ_PRAGMAS),
+    "snapshot": ("mode=ro&immutable=1", READ_PRAGMAS),
+    "output": ("mode=rwc", ["PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL", "PRAGMA cache_size=-65536",
+                            "PRAGMA temp_store=MEMORY", f"PRAGMA mmap_size={MMAP_SIZE}"]),
+}
+# (path, profile) -> open connection, so stages of a run (and runs of a long-lived process) share connections
+CONNECTIONS = {}
+
+def database_uri(db_path, options):
+    return f"file:{pathname2url(os.path.abspath(db_path))}?{options}"
+
+def open_connection(db_path, profile):
+    options, pragmas = CONNECTION_PROFILES[profile]
+    uri = "file::memory:" if db_path == ":memory:" else database_uri(db_path, options)
+    con = sqlite3.connect(uri, uri=True)
+    for pragma in pragmas:
+        con.execute(pragma)
+    return con
+
+def is_open(con):
+    try:
+        con.total_changes
+        return True
+    except sqlite3.ProgrammingError:
+        return False
+
+def source_signature(con, db_path):
+    # data_version moves when another connection commits, the file stats catch a WAL checkpoint or a file that was
+    # replaced outright (new inode, which open connections would never see)
+    stats = os.stat(db_path)
+    wal_path = db_path + "-wal"
+    wal = (os.stat(wal_path).st_mtime_ns, os.stat(wal_path).st_size) if os.path.exists(wal_path) else None
+    return stats.st_ino, stats.st_mtime_ns, stats.st_size, wal, con.execute("PRAGMA data_version").fetchone()[0]
+
+def connect_to_database(db_path, logger, profile=None, reuse=False):
     try:
-        con = sqlite3.connect(db_path)
-        logger.info("Connection to database established")
+        key = (os.path.abspath(db_path) if db_path != ":memory:" else db_path, profile)
+        if reuse and key in CONNECTIONS and is_open(CONNECTIONS[key]):
+            return CONNECTIONS[key]
+        con = sqlite3.connect(db_path) if profile is None else open_connection(db_path, profile)
+        if reuse:
+            CONNECTIONS[key] = con
+        logger.info("Connection to database established" + (f" ({profile})" if profile else ""))
         return con
 
     except Exception as e:
         logger.error(f"Failed to connect to DB with error:\n{e}")
         return None
 
-def extract_and_transform_data(cur, logger):
+def close_connections():
+    for con in CONNECTIONS.values():
+        if is_open(con):
+            if con.in_transaction:
+                con.rollback()
+            con.close()
+    CONNECTIONS.clear()
+
+def attach_database(cur, db_path, alias, profile="reader"):
+    # The URI form needs a connection opened through a profile (uri=True), a plain connection gets the bare path
+    if profile is None:
+        cur.execute(f"ATTACH DATABASE ? AS {alias}", (db_path,))
+    else:
+        cur.execute(f"ATTACH DATABASE ? AS {alias}", (database_uri(db_path, CONNECTION_PROFILES[profile][0]),))
+
+@contextmanager
+def attached(con, db_path, alias, profile="reader"):
+    # ATTACH and DETACH are refused inside a transaction, so a run that needs the source attaches it before its BEGIN
+    # and the stages find it already there. Only the call that attached the DB detaches it, first ending a transaction
+    # left open by an error
+    if any(row[1] == alias for row in con.execute("PRAGMA database_list")):
+        yield False
+        return
+    attach_database(con.cursor(), db_path, alias, profile)
+    try:
+        yield True
+    finally:
+        if con.in_transaction:
+            con.rollback()
+        con.execute(f"DETACH DATABASE {alias}")
+
+def begin(con, cur):
+    # Stages join the transaction a run already has open, so only the run's own commit makes their writes durable
+    if con.in_transaction:
+        return False
+    cur.execute("BEGIN")
+    return True
+
+def install_change_tracking(con, cur, logger):
+    try:
+        cur.execute("""
+                    CREATE TABLE IF NOT EXISTS cademycode_students_changes(
+                    change_id integer PRIMARY KEY AUTOINCREMENT,
+                    student_rowid integer,
+                    uuid integer,
+                    operation text)
+                    """)
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS cademycode_students_track_insert
+                       AFTER INSERT ON cademycode_students BEGIN
+                       INSERT INTO cademycode_students_changes (student_rowid, uuid, operation)
+                       VALUES (new.rowid, new.uuid, 'I'); END""")
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS cademycode_students_track_update
+                       AFTER UPDATE ON cademycode_students BEGIN
+                       INSERT INTO cademycode_students_changes (student_rowid, uuid, operation)
+                       VALUES (new.rowid, new.uuid, 'U'); END""")
+        cur.execute("""CREATE TRIGGER IF NOT EXISTS cademycode_students_track_delete
+                       AFTER DELETE ON cademycode_students BEGIN
+                       INSERT INTO cademycode_students_changes (student_rowid, uuid, operation)
+                       VALUES (old.rowid, old.uuid, 'D'); END""")
+        con.commit()
+        logger.info("Change tracking triggers installed on source database")
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to install change tracking with error:\n{e}")
+        return None
+
+def ensure_watermark_table(cur):
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS extract_watermarks(
+                source_table text PRIMARY KEY,
+                mode text,
+                watermark text,
+                updated_at text)
+                """)
+
+def table_checksum(cur, table):
+    rows = cur.execute(f"SELECT * FROM {table} ORDER BY rowid").fetchall()
+    return hashlib.md5(repr(rows).encode("utf-8")).hexdigest()
+
+def plan_extraction(input_cur, output_cur, logger, full_refresh=False):
+    try:
+        ensure_watermark_table(output_cur)
+        saved = {row[0]: (row[1], row[2]) for row in
+                 output_cur.execute("SELECT source_table, mode, watermark FROM extract_watermarks")}
+
+        tracked = input_cur.execute("""SELECT name FROM sqlite_master
+                                       WHERE type = 'table' AND name = 'cademycode_students_changes'""").fetchone()
+        if tracked:
+            mode = "changes"
+            upto = input_cur.execute("SELECT coalesce(max(change_id), 0) FROM cademycode_students_changes").fetchone()[0]
+        else:
+            mode = "rowid"
+            upto = input_cur.execute("SELECT coalesce(max(rowid), 0) FROM cademycode_students").fetchone()[0]
+        checksums = {table: table_checksum(input_cur, table) for table in DIMENSION_TABLES}
+        # A change to the output columns needs every row rebuilt, not just the ones past the watermark
+        checksums["students_analysis"] = hashlib.md5(",".join(ANALYSIS_COLUMNS).encode("utf-8")).hexdigest()
+
+        plan = {"full": True, "mode": mode, "since": None, "upto": upto, "checksums": checksums, "deleted": []}
+        previous = saved.get("cademycode_students")
+        if full_refresh:
+            logger.info("Full refresh requested, extracting all source rows")
+        elif previous is None or previous[0] != mode:
+            logger.info("No usable watermark for cademycode_students, extracting all source rows")
+        elif int(previous[1]) > upto:
+            logger.info("Source watermark went backwards (source rebuilt?), extracting all source rows")
+        elif any(saved.get(table, (None, None))[1] != checksum for table, checksum in checksums.items()):
+            logger.info("Dimension tables or output columns changed since last run, extracting all source rows")
+        else:
+            plan["full"] = False
+            plan["since"] = int(previous[1])
+            if mode == "changes":
+                deleted = input_cur.execute("""SELECT DISTINCT uuid FROM cademycode_students_changes
+                                               WHERE operation = 'D' AND change_id > ? AND change_id <= ?
+                                               AND uuid NOT IN (SELECT uuid FROM cademycode_students)""",
+                                            (plan["since"], upto)).fetchall()
+                plan["deleted"] = [row[0] for row in deleted]
+            logger.info(f"Incremental extraction by {mode} from watermark {plan['since']} to {upto}")
+        return plan
+
+    except Exception as e:
+        logger.error(f"Failed to plan extraction with error:\n{e}")
+        return None
+
+def students_query(plan=None, uuid_range=None):
+    if plan is None or plan["full"]:
+        query, params = "SELECT * FROM cademycode_students", ()
+    elif plan["mode"] == "changes":
+        query, params = ("""SELECT * FROM cademycode_students WHERE rowid IN
+                            (SELECT student_rowid FROM cademycode_students_changes
+                             WHERE change_id > ? AND change_id <= ?)""", (plan["since"], plan["upto"]))
+    else:
+        query, params = "SELECT * FROM cademycode_students WHERE rowid > ? AND rowid <= ?", (plan["since"], plan["upto"])
+    if uuid_range is not None:
+        query, params = f"SELECT * FROM ({query}) WHERE uuid BETWEEN ? AND ?", (*params, *uuid_range)
+    return query, params
+
+def shard_ranges(cur, plan, shard_size, logger):
     try:
-        students = cur.execute("SELECT * FROM cademycode_students")
-        students_df = pd.DataFrame(students,
-                               columns=['uuid', 'name', 'dob', 'sex', 'contact_info', 'job_id', 'num_course_taken',
-                                        'current_career_path_id', 'time_spent_hrs'])
-        students_df.set_index(["uuid"])
-        students_jobs = cur.execute("SELECT * FROM cademycode_student_jobs")
-        students_jobs_df = pd.DataFrame(students_jobs, columns=['job_id', 'job_catagory', 'avg_salary'])
-        courses = cur.execute("SELECT * FROM cademycode_courses")
+        query, params = students_query(plan)
+        # Balanced by row count: every shard_size distinct uuids in order make one (first, last) range
+        shards = cur.execute(f"""SELECT min(uuid), max(uuid) FROM
+                                 (SELECT uuid, (row_number() OVER (ORDER BY uuid) - 1) / ? AS shard
+                                  FROM (SELECT DISTINCT uuid FROM ({query}) WHERE uuid IS NOT NULL))
+                                 GROUP BY shard ORDER BY shard""", (shard_size, *params)).fetchall()
+        logger.info(f"Students split into {len(shards)} uuid shards of up to {shard_size} rows")
+        return shards
+
+    except Exception as e:
+        logger.error(f"Failed to split students into shards with error:\n{e}")
+        return None
+
+def write_watermarks(cur, plan):
+    ensure_watermark_table(cur)
+    updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = [("cademycode_students", plan["mode"], str(plan["upto"]), updated_at)]
+    rows += [(table, "checksum", checksum, updated_at) for table, checksum in plan["checksums"].items()]
+    cur.executemany("INSERT OR REPLACE INTO extract_watermarks VALUES (?, ?, ?, ?)", rows)
+
+def save_watermarks(con, cur, plan, logger):
+    try:
+        own = begin(con, cur)
+        write_watermarks(cur, plan)
+        if own:
+            con.commit()
+        logger.info(f"Watermark for cademycode_students saved at {plan['upto']}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to save watermarks with error:\n{e}")
+        return None
+
+# Dimension lookups keyed by table, each kept with the checksum of the rows it was built from
+DIMENSION_CACHE = {}
+
+def course_lookup(courses_df):
+    courses_df = courses_df.drop_duplicates("career_path_id")
+    names = pd.Categorical(courses_df["career_path_name"])
+    # Each array ends with a no-match entry, so the -1 that get_indexer returns for a miss takes it directly
+    return {"index": pd.Index(courses_df["career_path_id"]),
+            "name_codes": np.append(names.codes, -1),
+            "names": names.categories,
+            "hours_to_complete": np.append(courses_df["hours_to_complete"].to_numpy(dtype="float64"), np.nan)}
+
+def read_dimensions(cur, checksums=None):
+    checksum = (checksums or {}).get("cademycode_courses") or table_checksum(cur, "cademycode_courses")
+    cached = DIMENSION_CACHE.get("cademycode_courses")
+    if cached is None or cached[0] != checksum:
+        courses = cur.execute("SELECT * FROM cademycode_courses").fetchall()
         courses_df = pd.DataFrame(courses, columns=['career_path_id', 'career_path_name', 'hours_to_complete'])
+        cached = DIMENSION_CACHE["cademycode_courses"] = (checksum, course_lookup(courses_df))
+    return cached[1]
+
+def decode_json_column(values):
+    values = values.where(values.notna(), "null").tolist()
+    # Each value is decoded on its own so a malformed value can never borrow its neighbour's data
+    parsed = []
+    for value in values:
+        try:
+            parsed.append(json_loads(value))
+        except (ValueError, TypeError):
+            parsed.append(None)
+    return parsed
+
+def parse_contact_info(contact_info):
+    records = [item if isinstance(item, dict) else {} for item in decode_json_column(contact_info)]
+    contact_df = pd.DataFrame.from_records(records, columns=["mailing_address", "email"], index=contact_info.index)
+    contact_df = contact_df.astype("string")
+    address_parts = contact_df["mailing_address"].str.rsplit(", ", n=3, expand=True).reindex(columns=range(4))
+    contact_df[ADDRESS_COLUMNS] = address_parts.astype("string").to_numpy()
+    return contact_df.astype("string")
+
+def clean_students(students_df):
+    for column in ["job_id", "num_course_taken", "current_career_path_id", "time_spent_hrs"]:
+        students_df[column] = pd.to_numeric(students_df[column], errors="coerce")
+    students_df["job_id"] = students_df["job_id"].fillna(99).astype("Int64")
+    students_df = students_df.astype({"num_course_taken": "Float64", "time_spent_hrs": "Float64"})
+
+    contact_df = parse_contact_info(students_df["contact_info"])
+    return pd.concat([students_df, contact_df], axis=1)
+
+def build_wide_df(students_int_df, courses):
+    # Left join on current_career_path_id: one index lookup, then take by position
+    positions = courses["index"].get_indexer(students_int_df["current_career_path_id"])
+    career_path_name = pd.Categorical.from_codes(courses["name_codes"].take(positions), courses["names"])
+    hours_to_complete = courses["hours_to_complete"].take(positions)
+
+    # Decoded to the dtype of the names themselves, as plain_dtypes does, so unmatched ids stay missing (a "str"
+    # cast turns them into the text 'nan' before pandas 3)
+    wide_df = students_int_df.assign(career_path_name=pd.Series(career_path_name, index=students_int_df.index)
+                                     .astype(courses["names"].dtype),
+                                     hours_to_complete=hours_to_complete)
+    return wide_df[ANALYSIS_COLUMNS].reset_index(drop=True)
 
-        students_df["job_id"] = students_df["job_id"].fillna(99)
-        students_jobs_df.loc[len(students_jobs_df)] = [99, 'N/A', 'N/A']
+def numeric_sql(column):
+    # to_numeric(errors="coerce") in SQL: REAL vs TEXT affinity compares the text as a number, so only numeric
+    # text equals its own cast and everything else becomes NULL
+    return f"CASE WHEN CAST({column} AS REAL) = CAST({column} AS TEXT) THEN CAST({column} AS REAL) END"
+
+def transform_query(plan=None, uuid_range=None):
+    query, params = students_query(plan, uuid_range)
+    contact = "CASE WHEN json_valid(s.contact_info) AND json_type(s.contact_info) = 'object' THEN CAST(json_extract(" \
+              "s.contact_info, '$.{}') AS TEXT) END"
+    # mailing_address as a JSON array of its ", " separated parts, to mirror str.rsplit(", ", n=3): up to four parts
+    # fill street..zip from the left, past four the last three are city, state and zip and the rest is the street
+    part = "(CASE WHEN n <= 4 THEN parts ->> {} ELSE parts ->> '$[#-{}]' END)"
+    # MATERIALIZED keeps sqlite from inlining the CTEs, which would re-run the JSON functions at every reference
+    return f"""WITH students AS ({query}),
+               courses AS (SELECT career_path_id, career_path_name, hours_to_complete, min(rowid)
+                           FROM cademycode_courses GROUP BY career_path_id),
+               typed AS MATERIALIZED (SELECT s.uuid, s.name, s.dob, s.sex, s.contact_info,
+                                coalesce(CAST({numeric_sql("s.job_id")} AS INTEGER), 99) AS job_id,
+                                {numeric_sql("s.num_course_taken")} AS num_course_taken,
+                                {numeric_sql("s.current_career_path_id")} AS current_career_path_id,
+                                {numeric_sql("s.time_spent_hrs")} AS time_spent_hrs,
+                                {contact.format("mailing_address")} AS mailing_address,
+                                {contact.format("email")} AS email
+                         FROM students s),
+               split AS MATERIALIZED (SELECT *, json_array_length(parts) AS n FROM
+                         (SELECT *, '[' || replace(json_quote(mailing_address), ', ', '","') || ']' AS parts FROM typed))
+               SELECT t.uuid, t.name, t.dob, t.sex, t.contact_info, t.job_id, t.num_course_taken,
+                      t.current_career_path_id, t.time_spent_hrs, c.career_path_name,
+                      CAST(c.hours_to_complete AS REAL), t.mailing_address, t.email,
+                      CASE WHEN n <= 4 THEN parts ->> 0
+                           ELSE substr(mailing_address, 1, length(mailing_address) - length(parts ->> '$[#-3]')
+                                       - length(parts ->> '$[#-2]') - length(parts ->> '$[#-1]') - 6) END,
+                      {part.format(1, 3)}, {part.format(2, 2)}, {part.format(3, 1)}
+               FROM split t LEFT JOIN courses c ON c.career_path_id = t.current_career_path_id""", params
+
+def typed_wide_df(rows):
+    # Rows from transform_query or students_analysis, given the dtypes the pandas transform produces
+    wide_df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows, columns=ANALYSIS_COLUMNS)
+    types = {"job_id": "Int64", "num_course_taken": "Float64", "current_career_path_id": "float64",
+             "time_spent_hrs": "Float64", "hours_to_complete": "float64"}
+    types.update({column: "string" for column in CONTACT_COLUMNS})
+    return wide_df[ANALYSIS_COLUMNS].astype(types).reset_index(drop=True)
+
+def format_dates(dates):
+    text = pd.Series(np.datetime_as_string(dates.to_numpy(dtype="datetime64[D]"), unit="D"), index=dates.index,
+                     dtype="str")
+    return text.where(dates.notna())
+
+def parse_dates(text):
+    parsed = pd.to_datetime(text, format="%Y-%m-%d", errors="coerce")
+    # Only used when every date formats back to the exact stored text, so loads and hashes do not change
+    present = text.notna()
+    if (parsed.notna() == present).all() and (format_dates(parsed)[present] == text[present]).all():
+        return parsed
+    return None
+
+def compact_dtypes(wide_df, logger=None):
+    # In-memory dtype policy: categories for low-cardinality columns, float32 where it is lossless, the smallest
+    # integer for uuid, dob as datetime64 and pyarrow-backed strings for the text when pyarrow is installed (pandas 3
+    # already stores its default str dtype that way). plain_dtypes undoes it.
+    compact = wide_df.astype({column: "category" for column in CATEGORY_COLUMNS})
+    for column in NUMERIC_COLUMNS:
+        dtype = str(compact[column].dtype)
+        if dtype in FLOAT32_TYPES:
+            narrowed = compact[column].astype(FLOAT32_TYPES[dtype])
+            if narrowed.astype(dtype).equals(compact[column]):
+                compact[column] = narrowed
+    compact["uuid"] = pd.to_numeric(compact["uuid"], downcast="integer")
+    if not pd.api.types.is_datetime64_any_dtype(compact["dob"]):
+        dates = parse_dates(compact["dob"])
+        if dates is not None:
+            compact["dob"] = dates
+    if ARROW_STRING is not None:
+        for column in TEXT_COLUMNS:
+            dtype = compact[column].dtype
+            if pd.api.types.is_object_dtype(dtype) or (isinstance(dtype, pd.StringDtype) and dtype.storage == "python"):
+                compact[column] = compact[column].astype(ARROW_STRING)
+
+    if logger is not None and len(wide_df):
+        before = wide_df.memory_usage(deep=True).sum()
+        after = compact.memory_usage(deep=True).sum()
+        logger.info(f"Compact dtypes: {before / 1e6:.2f} MB -> {after / 1e6:.2f} MB in memory "
+                    f"({1 - after / before:.0%} saved)")
+    return compact
+
+def plain_dtypes(wide_df):
+    # The dtypes the transform produces, used wherever values leave pandas (sqlite, hashes, exports)
+    types = {}
+    for column, dtype in wide_df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            types[column] = dtype.categories.dtype
+        elif str(dtype) in ("Float32", "float32"):
+            types[column] = str(dtype).replace("32", "64")
+        elif pd.api.types.is_integer_dtype(dtype) and not pd.api.types.is_extension_array_dtype(dtype):
+            types[column] = "int64"
+        elif dtype == ARROW_STRING and column in CONTACT_COLUMNS:
+            types[column] = "string"
+    plain = wide_df.astype(types) if types else wide_df
+    for column in TEXT_COLUMNS:
+        if column in plain and column not in CONTACT_COLUMNS and plain[column].dtype == ARROW_STRING:
+            # Back to the object column sqlite rows give before pandas 3, with None for missing text
+            plain = plain.assign(**{column: plain[column].astype(object).where(plain[column].notna(), None)})
+    if "dob" in plain and pd.api.types.is_datetime64_any_dtype(plain["dob"]):
+        plain = plain.assign(dob=format_dates(plain["dob"]))
+    return plain
+
+def extract_and_transform_data(cur, logger, plan=None, transform="pandas"):
+    if transform == "sql":
+        try:
+            wide_df = compact_dtypes(typed_wide_df(cur.execute(*transform_query(plan)).fetchall()), logger)
+            logger.info("Wide dataframe built in SQL (join, null fill and contact parsing pushed down)")
+            log_row_sample(logger, wide_df, "transformed")
+            return wide_df
+
+        except Exception as e:
+            logger.error(f"Failed to extract and transform data in SQL with error:\n{e}")
+            return None
+
+    try:
+        students = cur.execute(*students_query(plan))
+        students_df = pd.DataFrame(students, columns=STUDENT_COLUMNS)
+        courses = read_dimensions(cur, plan["checksums"] if plan else None)
+
+        students_int_df = clean_students(students_df)
         logger.info("Cleaned null values from job entries")
-        students_float_df = students_df.astype({"job_id": "float", "current_career_path_id": "float"})
-        students_int_df = students_float_df.astype({"job_id": "Int64", "current_career_path_id": "float"})
+        logger.info("Contact info parsed into address and email columns")
         logger.info("Intial DataFrames created")
 
 
@@ -61,22 +585,67 @@ def extract_and_transform_data(cur, logger):
         return None
 
     try:
-        wide_df_prep = pd.merge(students_int_df, students_jobs_df, on="job_id")
-        wide_df_prep = pd.merge(students_int_df, courses_df, left_on="current_career_path_id",
-                                right_on="career_path_id",
-                                how="left")
-        wide_df = wide_df_prep[["uuid", "name", "dob", "sex", "contact_info", "job_id", "num_course_taken",
-                                "current_career_path_id", "time_spent_hrs", "career_path_name",
-                                "hours_to_complete"]].copy()
-        wide_df = wide_df.astype({"num_course_taken": "Float64", "time_spent_hrs": "Float64"})
-        wide_df.set_index(["uuid"])
+        wide_df = compact_dtypes(build_wide_df(students_int_df, courses), logger)
         logger.info("Wide dataframe created and prepared")
+        log_row_sample(logger, wide_df, "transformed")
         return wide_df
 
     except Exception as e:
         logger.error(f"Failed to create wide_df with error:\n{e}")
         return None
 
+def extract_and_transform_chunks(cur, logger, plan=None, chunksize=50000, transform="pandas"):
+    try:
+        if transform == "sql":
+            students = cur.execute(*transform_query(plan))
+        else:
+            courses = read_dimensions(cur, plan["checksums"] if plan else None)
+            students = cur.execute(*students_query(plan))
+        logger.info(f"Streaming students in chunks of {chunksize} rows")
+    except Exception as e:
+        logger.error(f"Failed to extract data with error:\n{e}")
+        yield None
+        return
+
+    chunk_number = 0
+    while True:
+        try:
+            rows = students.fetchmany(chunksize)
+            if not rows:
+                return
+            chunk_number += 1
+            if transform == "sql":
+                wide_df = typed_wide_df(rows)
+            else:
+                wide_df = build_wide_df(clean_students(pd.DataFrame(rows, columns=STUDENT_COLUMNS)), courses)
+            wide_df = compact_dtypes(wide_df, logger)
+            logger.info(f"Chunk {chunk_number} transformed, {len(wide_df)} rows")
+            log_row_sample(logger, wide_df, f"chunk {chunk_number} transformed")
+        except Exception as e:
+            logger.error(f"Failed to transform chunk {chunk_number} with error:\n{e}")
+            yield None
+            return
+        yield wide_df
+
+def diff_shard(db, output_db, plan, uuid_range, source_profile="reader", transform="pandas"):
+    # Runs in a worker process with read-only connections, the parent process applies the returned diff
+    source = open_connection(db, source_profile)
+    output = open_connection(output_db, "reader")
+    try:
+        if transform == "sql":
+            wide_df = typed_wide_df(source.execute(*transform_query(plan, uuid_range)).fetchall())
+        else:
+            students = source.execute(*students_query(plan, uuid_range)).fetchall()
+            students_df = pd.DataFrame(students, columns=STUDENT_COLUMNS)
+            courses = read_dimensions(source.cursor(), plan["checksums"])
+            wide_df = build_wide_df(clean_students(students_df), courses)
+        diff = diff_data(compact_dtypes(wide_df), output.cursor(), detect_deletes=False)
+        diff["rows"] = len(wide_df)
+        return diff
+    finally:
+        source.close()
+        output.close()
+
 def connect_output_db(output_db, logger):
     try:
         con1 = sqlite3.connect(output_db)
@@ -87,71 +656,550 @@ def connect_output_db(output_db, logger):
         logger.error("Connection to output database failed with error:\n{e}")
         return None
 
-def intialize_output_db(con, cur, logger):
+def intialize_output_db(con, cur, logger, without_rowid=False):
     try:
-        students_analysis = cur.execute("SELECT * FROM students_analysis").fetchall()
-        logger.info("Table in output exists, gathering data")
-        return students_analysis
+        exists = cur.execute("""SELECT name FROM sqlite_master
+                                WHERE type = 'table' AND name = 'students_analysis'""").fetchone()
+        if exists:
+            logger.info("Table in output exists, checking schema version")
+        else:
+            logger.info(f"Table in out put dosent exist....Creating Table ")
+        return migrate_output_db(con, cur, logger, without_rowid)
 
-    except sqlite3.OperationalError:
-        logger.error(f"Table in out put dosent exist....Creating Table ")
-        cur.execute("""
-                            CREATE TABLE students_analysis(
-                            uuid integer,
-                            name object,
-                            dob object,
-                            sex object,
-                            contact_info object,
-                            job_id Int64,
-                            num_course_taken object,
-                            current_career_path_id float64,
-                            time_spent_hrs object,
-                            career_path_name object,
-                            hours_to_complete float64)
-                        """)
+    except Exception as e:
+        logger.error(f"Querying output DB failed with error:\n {e}")
+        return None
+
+def analysis_table_sql(table, without_rowid=False):
+    columns = ",\n".join(f"{column} {ANALYSIS_TYPES[column]}" for column in ANALYSIS_COLUMNS)
+    return f"CREATE TABLE {table}(\n{columns})" + (" WITHOUT ROWID" if without_rowid else "")
+
+def create_typed_table(cur, without_rowid=False):
+    existing = [row[0] for row in cur.execute("SELECT name FROM pragma_table_info('students_analysis')")]
+    cur.execute(analysis_table_sql("students_analysis_typed", without_rowid))
+    if existing:
+        # Older tables had no key and may hold duplicate uuids, keep the most recently appended copy
+        select = ", ".join(column if column in existing else "NULL" for column in ANALYSIS_COLUMNS)
+        cur.execute(f"""INSERT INTO students_analysis_typed ({", ".join(ANALYSIS_COLUMNS)})
+                        SELECT {select} FROM students_analysis
+                        WHERE rowid IN (SELECT max(rowid) FROM students_analysis
+                                        WHERE uuid IS NOT NULL GROUP BY uuid)""")
+        cur.execute("DROP TABLE students_analysis")
+    cur.execute("ALTER TABLE students_analysis_typed RENAME TO students_analysis")
+
+def create_lookup_indexes(cur, without_rowid=False):
+    cur.execute("CREATE INDEX IF NOT EXISTS students_analysis_career_path ON students_analysis(current_career_path_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS students_analysis_job ON students_analysis(job_id)")
+
+def create_hash_table(cur, without_rowid=False):
+    ensure_hash_table(cur)
+
+def create_change_tables(cur, without_rowid=False):
+    # Append only: one row per inserted (I), updated (U) or deleted (D) student per run. run_id is the run's start
+    # time (YYYYmmddHHMMSSffffff) so "changes since run X" is a range scan on the run_id index
+    cur.execute("""
+                CREATE TABLE students_analysis_changes(
+                change_id INTEGER PRIMARY KEY,
+                run_id TEXT NOT NULL,
+                uuid INTEGER NOT NULL,
+                operation TEXT NOT NULL,
+                changed_columns TEXT,
+                changed_at TEXT)
+                """)
+    cur.execute("CREATE INDEX students_analysis_changes_run ON students_analysis_changes(run_id, uuid)")
+    cur.execute("CREATE INDEX students_analysis_changes_uuid ON students_analysis_changes(uuid, change_id)")
+    cur.execute("""
+                CREATE TABLE pipeline_runs(
+                run_id TEXT PRIMARY KEY,
+                started_at TEXT,
+                finished_at TEXT,
+                status TEXT,
+                duration_seconds REAL,
+                rows_read INTEGER,
+                rows_inserted INTEGER,
+                rows_updated INTEGER,
+                rows_unchanged INTEGER,
+                rows_deleted INTEGER,
+                bytes_written INTEGER)
+                """)
+
+def create_checkpoint_tables(cur, without_rowid=False):
+    # students_pending holds the changes a run has diffed but not yet applied, pipeline_checkpoints the last stage
+    # each run completed (diffed, loaded, published) so a failed run can be resumed from there
+    create_pending_tables(cur)
+    cur.execute("""
+                CREATE TABLE pipeline_checkpoints(
+                run_id TEXT PRIMARY KEY,
+                stage TEXT NOT NULL,
+                plan TEXT,
+                counters TEXT,
+                output_format TEXT,
+                output_file TEXT,
+                updated_at TEXT)
+                """)
+
+# Applied in order, PRAGMA user_version records the last one an output DB has had
+MIGRATIONS = [
+    (1, "typed students_analysis keyed on uuid", create_typed_table),
+    (2, "indexes on current_career_path_id and job_id", create_lookup_indexes),
+    (3, "students_analysis_hashes", create_hash_table),
+    (4, "students_analysis_changes and pipeline_runs", create_change_tables),
+    (5, "students_pending and pipeline_checkpoints", create_checkpoint_tables),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def apply_migrations(cur, without_rowid=False):
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    applied = []
+    for number, description, migration in MIGRATIONS:
+        if number > version:
+            migration(cur, without_rowid)
+            cur.execute(f"PRAGMA user_version = {number}")
+            applied.append(f"{number} ({description})")
+    return applied
+
+def migrate_output_db(con, cur, logger, without_rowid=False):
+    try:
+        if not con.in_transaction:
+            cur.execute("BEGIN")
+        applied = apply_migrations(cur, without_rowid)
         con.commit()
-        students_analysis = cur.execute("SELECT * FROM students_analysis").fetchall()
-        logger.info("Empty dataframe prepared for analysis")
-        return students_analysis
+        for migration in applied:
+            logger.info(f"Output DB migrated to schema version {migration}")
+        return SCHEMA_VERSION
 
     except Exception as e:
-        logger.error(f"Querying output DB failed with error:\n {e}")
+        con.rollback()
+        logger.error(f"Output DB schema migration failed with error:\n{e}")
+        return None
+
+def create_staging_table(cur):
+    cur.execute("DROP TABLE IF EXISTS temp.students_staging")
+    cur.execute(analysis_table_sql("temp.students_staging"))
+
+def stage_rows(data, con, cur, logger, batch_size=LOAD_BATCH_SIZE):
+    try:
+        own = begin(con, cur)
+        placeholders = ", ".join("?" for _ in ANALYSIS_COLUMNS)
+        data = data[ANALYSIS_COLUMNS].drop_duplicates("uuid", keep="last")
+        for start in range(0, len(data), batch_size):
+            cur.executemany(f"INSERT OR REPLACE INTO temp.students_staging VALUES ({placeholders})",
+                            to_records(data.iloc[start:start + batch_size]))
+        if own:
+            con.commit()
+        return len(data)
+
+    except Exception as e:
+        con.rollback()
+        logger.error(f"Failed to stage rows for the SQL diff with error:\n{e}")
+        return None
+
+def stage_transformed(con, cur, source_db, plan, logger, source_profile="reader"):
+    # Pushdown staging: the source is attached to the output connection and transform_query fills the staging
+    # table directly, so no student row passes through Python
+    try:
+        with attached(con, source_db, "source", source_profile):
+            own = begin(con, cur)
+            query, params = transform_query(plan)
+            cur.execute(f"INSERT OR REPLACE INTO temp.students_staging {query}", params)
+            staged = cur.execute("SELECT count(*) FROM temp.students_staging").fetchone()[0]
+            if own:
+                con.commit()
+        logger.info(f"Staged {staged} students transformed in SQL")
+        return staged
+
+    except Exception as e:
+        con.rollback()
+        logger.error(f"Failed to stage transformed rows for the SQL diff with error:\n{e}")
         return None
 
-def compare_and_update_data(wide_df, cur, con, logger):
+def sql_diff_load(con, cur, logger, metrics=None, apply=True, chunksize=None):
+    # Yields the changed rows as wide frames, chunksize rows at a time when given, hashing each one as it is read so
+    # the SQL diff keeps the same memory ceiling as the chunked runs. apply=False leaves the changes in the run's
+    # students_pending for load_pending, otherwise they go through a temp copy and are applied after the last frame
+    columns = ", ".join(ANALYSIS_COLUMNS)
+    schema = "temp" if apply else "main"
+    try:
+        own = begin(con, cur)
+        create_pending_tables(cur, schema)
+        # Everything staged that differs from the stored row in any column, or has no stored row yet
+        cur.execute("DROP TABLE IF EXISTS temp.students_changed")
+        cur.execute(f"""CREATE TEMP TABLE students_changed AS
+                        SELECT {columns} FROM temp.students_staging
+                        EXCEPT SELECT {columns} FROM main.students_analysis""")
+        staged = cur.execute("SELECT count(*) FROM temp.students_staging").fetchone()[0]
+        changed, inserted = cur.execute("""SELECT count(*), count(*) FILTER (WHERE a.uuid IS NULL)
+                                           FROM temp.students_changed c
+                                           LEFT JOIN main.students_analysis a ON a.uuid = c.uuid""").fetchone()
+        cur.execute(f"""INSERT OR REPLACE INTO {schema}.students_pending ({columns})
+                        SELECT {columns} FROM temp.students_changed""")
+        query = f"SELECT {columns} FROM temp.students_changed ORDER BY uuid"
+        frames = pd.read_sql_query(query, con, chunksize=chunksize) if chunksize else [pd.read_sql_query(query, con)]
+
+    except Exception as e:
+        con.rollback()
+        logger.error(f"SQL diff of staged rows failed with error:\n{e}")
+        yield None
+        return
+
+    pm.count(metrics, "rows_diffed", staged)
+    pm.count(metrics, "rows_inserted", inserted)
+    pm.count(metrics, "rows_updated", changed - inserted)
+    pm.count(metrics, "rows_unchanged", staged - changed)
+    logger.info(f"Comparison dataframe completed: {inserted} inserts, {changed - inserted} updates, "
+                f"{staged - changed} unchanged")
+
+    for frame in frames:
+        try:
+            # Only the changed rows are hashed, read back with the pandas transform's dtypes so hash-mode runs agree
+            wide_diff_df = compact_dtypes(typed_wide_df(frame))
+            hashes = hash_rows(wide_diff_df)
+            cur.executemany(f"UPDATE {schema}.students_pending SET row_hash = ? WHERE uuid = ?",
+                            zip(hashes.tolist(), hashes.index.tolist()))
+        except Exception as e:
+            con.rollback()
+            logger.error(f"Hashing the SQL diff's changed rows failed with error:\n{e}")
+            yield None
+            return
+        if apply:
+            log_row_sample(logger, wide_diff_df, "loaded")
+        yield wide_diff_df
+
+    try:
+        if apply:
+            apply_pending(cur, pm.run_id(metrics), schema)
+            clear_pending(cur, schema)
+        if own:
+            con.commit()
+    except Exception as e:
+        con.rollback()
+        logger.error(f"SQL diff of staged rows failed with error:\n{e}")
+        yield None
+        return
+    if apply:
+        logger.warning(f"Pushed {changed} rows to output DB successfully "
+                       f"({inserted} new, {changed - inserted} updated)")
+
+def ensure_hash_table(cur):
+    exists = cur.execute("""SELECT name FROM sqlite_master
+                            WHERE type = 'table' AND name = 'students_analysis_hashes'""").fetchone()
+    if exists:
+        return
+    cur.execute("""
+                CREATE TABLE students_analysis_hashes(
+                uuid integer PRIMARY KEY,
+                row_hash integer)
+                """)
+    # Rows loaded before the hash table existed get a NULL hash so the next diff rewrites them once
+    cur.execute("""INSERT OR IGNORE INTO students_analysis_hashes (uuid, row_hash)
+                   SELECT DISTINCT uuid, NULL FROM students_analysis""")
+
+def hash_rows(df):
+    # Numeric columns are hashed as Float64 so a chunk whose merge produced int64 instead of float64 still matches,
+    # and compacted columns go back to their plain dtypes so the dtype policy never changes a hash
+    plain = plain_dtypes(df)
+    canonical = plain[ANALYSIS_COLUMNS[1:]].astype({column: "Float64" for column in NUMERIC_COLUMNS})
+    hashes = pd.util.hash_pandas_object(canonical, index=False)
+    return pd.Series(hashes.to_numpy().view("int64"), index=plain["uuid"].to_numpy())
+
+def read_row_hashes(cur, uuids=None):
+    if uuids is None:
+        rows = cur.execute("SELECT uuid, row_hash FROM students_analysis_hashes").fetchall()
+    elif len(uuids) == 0:
+        rows = []
+    else:
+        rows = cur.execute("""SELECT uuid, row_hash FROM students_analysis_hashes
+                              WHERE uuid IN (SELECT value FROM json_each(?))""",
+                           (json.dumps([int(uuid) for uuid in uuids]),)).fetchall()
+    uuid_values = [row[0] for row in rows]
+    hash_values = pd.array([row[1] for row in rows], dtype="Int64")
+    return pd.Series(hash_values, index=pd.Index(uuid_values, dtype="int64"))
+
+def diff_data(wide_df, cur, detect_deletes=True, deleted_uuids=None):
+    wide_df = wide_df.drop_duplicates("uuid", keep="last")
+    new_hashes = hash_rows(wide_df)
+    old_hashes = read_row_hashes(cur, None if detect_deletes else new_hashes.index)
+
+    known = new_hashes.index.isin(old_hashes.index)
+    previous = old_hashes.reindex(new_hashes.index)
+    changed = (previous != new_hashes.astype("Int64")).fillna(True).to_numpy(dtype=bool)
+
+    if detect_deletes:
+        deleted = old_hashes.index.difference(new_hashes.index)
+    else:
+        deleted = pd.Index(deleted_uuids or [], dtype="int64").difference(new_hashes.index)
+        deleted = deleted[deleted.isin(read_row_hashes(cur, deleted).index)] if len(deleted) else deleted
+    return {"insert": wide_df[~known],
+            "update": wide_df[known & changed],
+            "unchanged": int((known & ~changed).sum()),
+            "delete": deleted,
+            "hashes": new_hashes[~known | changed]}
+
+def compare_and_update_data(wide_df, cur, con, logger, detect_deletes=True, deleted_uuids=None,
+                            batch_size=LOAD_BATCH_SIZE, metrics=None, apply=True):
     try:
-        students_analysis = cur.execute("SELECT * FROM students_analysis").fetchall()
-        logger.info("Gathering existing data from output.")
-        students_analysis_df = pd.DataFrame(students_analysis,
-                                        columns=["uuid", "name", "dob", "sex", "contact_info", "job_id",
-                                                 "num_course_taken", "current_career_path_id", "time_spent_hrs",
-                                                 "career_path_name", "hours_to_complete"])
-        students_analysis_df.set_index(["uuid"])
-        logger.info("Analysis dataframe created.")
+        ensure_hash_table(cur)
         logger.info("Comparing input and output database information to find variance")
-        wide_diff_df = pd.concat([wide_df, students_analysis_df]).drop_duplicates(keep=False)
-        logger.info("Comparison dataframe completed")
+        with pm.stage(metrics, "diff_data"):
+            diff = diff_data(wide_df, cur, detect_deletes, deleted_uuids)
     except Exception as e:
         logger.error(f"Creation or comparison of analysis failed with error:\n{e}")
+        return None
+
+    return load_diff(diff, len(wide_df), con, cur, logger, batch_size, metrics, apply)
+
+def load_diff(diff, rows_diffed, con, cur, logger, batch_size=LOAD_BATCH_SIZE, metrics=None, apply=True):
+    wide_diff_df = pd.concat([diff["insert"], diff["update"]])
+    logger.info(f"Comparison dataframe completed: {len(diff['insert'])} inserts, {len(diff['update'])} updates, "
+                f"{diff['unchanged']} unchanged, {len(diff['delete'])} deletes")
+
+    with pm.stage(metrics, "load_students_analysis" if apply else "stage_changes"):
+        loaded = load_students_analysis(wide_diff_df, con, cur, logger, batch_size, diff["hashes"], diff["delete"],
+                                        pm.run_id(metrics), apply)
+    if loaded is None:
+        return None
+    pm.count(metrics, "rows_diffed", rows_diffed)
+    pm.count(metrics, "rows_inserted", len(diff["insert"]))
+    pm.count(metrics, "rows_updated", len(diff["update"]))
+    pm.count(metrics, "rows_unchanged", diff["unchanged"])
+    pm.count(metrics, "rows_deleted", len(diff["delete"]))
+    if apply:
+        logger.warning(f"Pushed {str(wide_diff_df.shape[0])} rows to output DB successfully "
+                       f"({len(diff['insert'])} new, {len(diff['update'])} updated, {len(diff['delete'])} removed)")
+        log_row_sample(logger, wide_diff_df, "loaded")
+    return wide_diff_df
+
+def to_records(df):
+    df = plain_dtypes(df)
+    values = df.astype(object).where(df.notna(), None)
+    return list(values.itertuples(index=False, name=None))
 
+def load_students_analysis(data, con, cur, logger, batch_size=LOAD_BATCH_SIZE, hashes=None, deleted_uuids=(),
+                           run_id=None, apply=True):
+    # The rows are staged in students_pending first. apply=False stops there, so a checkpointed run can export and
+    # apply them later (load_pending); otherwise a temp copy of the pending tables is applied straight away
+    schema = "temp" if apply else "main"
+    started = time.perf_counter()
     try:
-        wide_diff_df.to_sql("students_analysis", con, if_exists="append", chunksize=50, index=False, dtype=
-        {"uuid": "integer", "name": "object", "dob": "object", "sex": "object", "contact_info": "object",
-         "job_id": "Int64",
-         "num_course_taken": "object", "current_career_path": "Float64", "time_spent_hrs": "object",
-         "career_path_name": "object", "hours_to_complete": "Float62"})
-        con.commit
-        logger.warning(f"Pushed {str(wide_diff_df.shape[0])} rows to output DB successfully")
-        return wide_diff_df
+        own = begin(con, cur)
+        apply_migrations(cur)
+        create_pending_tables(cur, schema)
+        data = data[ANALYSIS_COLUMNS]
+        stage_pending(cur, data, hashes, deleted_uuids, batch_size, schema)
+        if apply:
+            apply_pending(cur, run_id, schema)
+            clear_pending(cur, schema)
+        if own:
+            con.commit()
 
     except Exception as e:
+        con.rollback()
         logger.error(f"Pipeline failed to push data to output DB with error:\n{e}")
         return None
 
-def generate_csv(data, csv_file, logger):
+    elapsed = time.perf_counter() - started
+    rate = len(data) / elapsed if elapsed > 0 else 0.0
+    logger.info(f"{'Loaded' if apply else 'Staged'} {len(data)} rows in {elapsed:.3f}s ({rate:,.0f} rows/s, "
+                f"batch size {batch_size})")
+    return len(data)
+
+def create_pending_tables(cur, schema="main"):
+    columns = ",\n".join(f"{column} {ANALYSIS_TYPES[column]}" for column in ANALYSIS_COLUMNS)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {schema}.students_pending(\n{columns},\nrow_hash INTEGER)")
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {schema}.students_pending_deletes(uuid INTEGER PRIMARY KEY)")
+
+def stage_pending(cur, data, hashes=None, deleted_uuids=(), batch_size=LOAD_BATCH_SIZE, schema="main"):
+    columns = ", ".join(ANALYSIS_COLUMNS + ["row_hash"])
+    placeholders = ", ".join("?" for _ in ANALYSIS_COLUMNS + ["row_hash"])
+    cur.executemany(f"INSERT OR IGNORE INTO {schema}.students_pending_deletes VALUES (?)",
+                    [(int(uuid),) for uuid in deleted_uuids])
+    # Rows loaded without a hash get NULL so the next diff re-checks them
+    row_hashes = None if hashes is None else hashes.astype("Int64").reindex(data["uuid"].astype("int64")).array
+    data = data.assign(row_hash=row_hashes)
+    for start in range(0, len(data), batch_size):
+        cur.executemany(f"INSERT OR REPLACE INTO {schema}.students_pending ({columns}) VALUES ({placeholders})",
+                        to_records(data.iloc[start:start + batch_size]))
+
+def apply_pending(cur, run_id=None, schema="main"):
+    pending, deletes = f"{schema}.students_pending", f"{schema}.students_pending_deletes"
+    columns = ", ".join(ANALYSIS_COLUMNS)
+    updates = ", ".join(f"{column} = excluded.{column}" for column in ANALYSIS_COLUMNS[1:])
+    # '["name", "time_spent_hrs"]' built in SQL, IS NOT so NULL to value counts as a change
+    changed_columns_sql = " || ".join(f"""CASE WHEN p.{column} IS NOT a.{column} THEN '"{column}", ' ELSE '' END"""
+                                      for column in ANALYSIS_COLUMNS)
+    changed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    deleted = cur.execute(f"""SELECT count(*) FROM main.students_analysis
+                              WHERE uuid IN (SELECT uuid FROM {deletes})""").fetchone()[0]
+    if run_id is not None:
+        cur.execute(f"""INSERT INTO main.students_analysis_changes (run_id, uuid, operation, changed_at)
+                        SELECT ?, uuid, 'D', ? FROM main.students_analysis
+                        WHERE uuid IN (SELECT uuid FROM {deletes})""",
+                    (run_id, changed_at))
+    cur.execute(f"DELETE FROM main.students_analysis WHERE uuid IN (SELECT uuid FROM {deletes})")
+    cur.execute(f"DELETE FROM main.students_analysis_hashes WHERE uuid IN (SELECT uuid FROM {deletes})")
+
+    inserted, updated = cur.execute(f"""SELECT count(*) FILTER (WHERE a.uuid IS NULL), count(a.uuid) FROM {pending} p
+                                        LEFT JOIN main.students_analysis a ON a.uuid = p.uuid""").fetchone()
+    if run_id is not None:
+        # Rows whose hash changed but whose stored values did not (NULL hashes) are rewritten without a log entry
+        cur.execute(f"""INSERT INTO main.students_analysis_changes
+                        (run_id, uuid, operation, changed_columns, changed_at)
+                        SELECT ?, uuid, operation, changed_columns, ? FROM
+                        (SELECT p.uuid, CASE WHEN a.uuid IS NULL THEN 'I' ELSE 'U' END AS operation,
+                                CASE WHEN a.uuid IS NOT NULL THEN '[' || rtrim({changed_columns_sql}, ', ') || ']'
+                                END AS changed_columns
+                         FROM {pending} p LEFT JOIN main.students_analysis a ON a.uuid = p.uuid)
+                        WHERE operation = 'I' OR changed_columns != '[]'""", (run_id, changed_at))
+    cur.execute(f"""INSERT INTO main.students_analysis ({columns}) SELECT {columns} FROM {pending} WHERE true
+                    ON CONFLICT(uuid) DO UPDATE SET {updates}""")
+    cur.execute(f"""INSERT INTO main.students_analysis_hashes (uuid, row_hash) SELECT uuid, row_hash FROM {pending}
+                    WHERE true ON CONFLICT(uuid) DO UPDATE SET row_hash = excluded.row_hash""")
+    return inserted, updated, deleted
+
+def clear_pending(cur, schema="main"):
+    cur.execute(f"DELETE FROM {schema}.students_pending")
+    cur.execute(f"DELETE FROM {schema}.students_pending_deletes")
+
+def stage_deleted_rows(con, cur, uuids, logger, metrics=None):
+    try:
+        own = begin(con, cur)
+        cur.executemany("INSERT OR IGNORE INTO students_pending_deletes VALUES (?)", [(int(uuid),) for uuid in uuids])
+        removed = cur.execute("""SELECT count(*) FROM students_analysis
+                                 WHERE uuid IN (SELECT value FROM json_each(?))""",
+                              (json.dumps([int(uuid) for uuid in uuids]),)).fetchone()[0]
+        if own:
+            con.commit()
+        logger.info(f"{removed} deleted students staged for removal from output DB")
+        pm.count(metrics, "rows_deleted", removed)
+        return removed
+
+    except Exception as e:
+        con.rollback()
+        logger.error(f"Failed to stage deleted students with error:\n{e}")
+        return None
+
+def stage_missing_rows(con, cur, source_db, logger, metrics=None, source_profile="reader"):
+    try:
+        with attached(con, source_db, "source", source_profile):
+            own = begin(con, cur)
+            cur.execute("""INSERT OR IGNORE INTO students_pending_deletes
+                           SELECT uuid FROM students_analysis
+                           WHERE uuid NOT IN (SELECT uuid FROM source.cademycode_students)""")
+            removed = cur.rowcount
+            if own:
+                con.commit()
+        logger.info(f"{removed} students missing from the source staged for removal from output DB")
+        pm.count(metrics, "rows_deleted", removed)
+        return removed
+
+    except Exception as e:
+        con.rollback()
+        logger.error(f"Failed to stage missing students with error:\n{e}")
+        return None
+
+def pending_frames(con, logger, chunksize=None):
+    # The staged changes as wide frames, read back the same way the SQL diff reads its changed rows
+    query = f"SELECT {', '.join(ANALYSIS_COLUMNS)} FROM students_pending ORDER BY uuid"
+    try:
+        frames = pd.read_sql_query(query, con, chunksize=chunksize) if chunksize else [pd.read_sql_query(query, con)]
+        for frame in frames:
+            yield compact_dtypes(typed_wide_df(frame))
+    except Exception as e:
+        logger.error(f"Failed to read staged changes with error:\n{e}")
+        yield None
+
+def read_checkpoint(cur, logger):
+    try:
+        row = cur.execute("""SELECT run_id, stage, plan, counters, output_format, output_file FROM pipeline_checkpoints
+                             WHERE stage != 'published' ORDER BY run_id DESC LIMIT 1""").fetchone()
+        if row is None:
+            return {}
+        return {"run_id": row[0], "stage": row[1], "plan": json.loads(row[2]), "counters": json.loads(row[3]),
+                "output_format": row[4], "output_file": row[5]}
+
+    except Exception as e:
+        logger.error(f"Failed to read the run checkpoint with error:\n{e}")
+        return None
+
+def save_checkpoint(cur, run_id, stage, plan=None, counters=None, output_format=None, output_file=None):
+    cur.execute("""INSERT INTO pipeline_checkpoints VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(run_id) DO UPDATE SET stage = excluded.stage, updated_at = excluded.updated_at""",
+                (run_id, stage, json.dumps(plan), json.dumps(counters), output_format, output_file,
+                 datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+def load_pending(con, cur, plan, logger, metrics=None):
+    # One transaction: the staged changes, the change log, the watermarks and the checkpoint all land together
+    started = time.perf_counter()
+    try:
+        own = begin(con, cur)
+        inserted, updated, deleted = apply_pending(cur, pm.run_id(metrics))
+        write_watermarks(cur, plan)
+        save_checkpoint(cur, pm.run_id(metrics), "loaded")
+        if own:
+            con.commit()
+
+    except Exception as e:
+        con.rollback()
+        logger.error(f"Pipeline failed to push data to output DB with error:\n{e}")
+        return None
+
+    elapsed = time.perf_counter() - started
+    rate = (inserted + updated) / elapsed if elapsed > 0 else 0.0
+    logger.info(f"Loaded {inserted + updated} rows in {elapsed:.3f}s ({rate:,.0f} rows/s)")
+    logger.info(f"Watermark for cademycode_students saved at {plan['upto']}")
+    logger.warning(f"Pushed {inserted + updated} rows to output DB successfully "
+                   f"({inserted} new, {updated} updated, {deleted} removed)")
+    return inserted + updated
+
+def finish_checkpoint(con, cur, run_id, logger):
+    try:
+        own = begin(con, cur)
+        clear_pending(cur)
+        save_checkpoint(cur, run_id, "published")
+        if own:
+            con.commit()
+        return True
+
+    except Exception as e:
+        con.rollback()
+        logger.error(f"Failed to close the run checkpoint with error:\n{e}")
+        return None
+
+def record_run(output_db, metrics, logger):
+    try:
+        con = connect_to_database(output_db, logger, "output", reuse=True)
+        if con is None:
+            return None
+        # A failed run can leave an open transaction behind, none of it may be committed with the run record
+        if con.in_transaction:
+            con.rollback()
+        cur = con.cursor()
+        cur.execute("BEGIN")
+        try:
+            apply_migrations(cur)
+            summary = metrics.as_dict()
+            counters = summary["counters"]
+            cur.execute("INSERT OR REPLACE INTO pipeline_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (metrics.run_id, summary["started_at"], datetime.now().isoformat(timespec="seconds"),
+                         summary["status"], summary["duration_seconds"], counters.get("rows_read", 0),
+                         counters.get("rows_inserted", 0), counters.get("rows_updated", 0),
+                         counters.get("rows_unchanged", 0), counters.get("rows_deleted", 0),
+                         counters.get("bytes_written", 0)))
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        logger.info(f"Run {metrics.run_id} recorded in pipeline_runs")
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to record run in output DB with error:\n{e}")
+        return None
+
+def generate_csv(data, csv_file, logger, append=False):
     try:
-        with open(csv_file, "w") as file:
-            data.to_csv(file)
+        with open(csv_file, "a" if append else "w") as file:
+            data.to_csv(file, index=False, header=not append)
         logger.info(f"Data exported to CSV, {len(data)} rows submitted.")
         return True
     except Exception as e:
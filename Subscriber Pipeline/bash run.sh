@@ -1,9 +1,8 @@
 #!/bin/sh
 
-python Pipeline_main.py
-
-prod_path=$"/prod/"
-time_stamp=$(date +%Y-%m-%d-%T)
-mkdir -p "${prod_path}/${time_stamp}"
-
-mv subscriber_pipeline.csv /dev/dev/ "${prod_path}/${time_stamp}"
\ No newline at end of file
+# Extra arguments are passed through, e.g. sh "bash run.sh" --output-format parquet
+# Each run's export is moved to /prod/<timestamp>/ by Pipeline_main.py itself, so a run that resumes a failed one
+# publishes both batches separately. A failed run exits non-zero and the next run resumes it from its checkpoint
+prod_path="/prod"
+mkdir -p "$prod_path"
+python Pipeline_main.py --publish-dir "$prod_path" "$@" || exit 1